@@ -6,29 +6,34 @@ Tools for retrieving catchment data.
 import paths
 
 import os
+import re
+import atexit
+import contextlib
+import functools
+import importlib.util
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 
-import geopandas as gpd
 import numpy as np
-import numpy.ma as ma
+from math import ceil
 from math import sqrt
 
-from shapely.geometry import Point
-from shapely.geometry import box
-from shapely.ops import nearest_points
-
 import rasterio
+from rasterio.io import MemoryFile
+from rasterio.transform import rowcol
 from rasterio.windows import Window
-from rasterio.plot import show
-from rasterio.plot import show_hist
-from rasterio.mask import mask
-
-from fiona.crs import from_epsg
+from rasterio.windows import from_bounds
 
-import json
+try:
+    from numba import njit
+except ImportError:
+    # numba is optional, without it the search kernels run as plain Python.
+    njit = None
 
-import matplotlib.pyplot as plt
-from matplotlib.colors import LogNorm
+# pyarrow is optional too, where installed its multithreaded parser is used
+# for reading csvs.
+CSV_ENGINE = "pyarrow" if importlib.util.find_spec("pyarrow") else "c"
 
 
 # LCM2015 dataset is split into layers, named at these coordinates.
@@ -38,31 +43,38 @@ LCM2015_NORTHING_LAYERS = (50000, 150000, 250000, 350000, 450000, 550000,
                            650000, 750000, 850000, 950000, 1050000, 1150000,
                            1250000)
 
-# Map for how many extra depths to check when finding closest grids. (See
-# closest_CCAR_above_val for more details).
-DEPTH_CHECK_MAP = {
-    0: 0,
-    1: 0,
-    2: 0,
-    3: 1,
-    4: 1,
-    5: 2,
-    6: 2,
-    7: 2,
-    8: 3,
-    9: 3,
-    10: 4,
-    11: 4,
-    12: 4,
-    13: 5,
-    14: 5,
-    15: 5,
-    16: 4,
-    17: 3,
-    18: 2,
-    19: 1,
-    20: 0,
-}
+# Descriptor tif filenames. FEH names end with the 4 character descriptor code
+# then a 3 character suffix, LCM names end with "_year_class".
+FEH_TIF_RE = re.compile(r"(.{4}).{3}\.tif$")
+LCM_TIF_RE = re.compile(r"_(\d{4})_(\d+)\.tif$")
+
+# West and east bounding boxes for NI, defined as [x_min,y_min,x_max,y_max].
+NI_BOUNDING_BOXES = np.array([[000000, 469190, 143723, 614827],
+                              [143723, 469190, 185797, 597050]])
+
+# Columns (in order) of the catchment descriptor database table.
+DB_COLUMNS = ("STATION", "PROPERTY_GROUP", "PROPERTY_ITEM", "PROPERTY_VALUE",
+              "PROPERTY_METHOD", "PROPERTY_COMMENT", "TITLE", "UNITS",
+              "SOURCE_VALUE")
+
+# Value used in the CCAR raster for cells with no data.
+CCAR_NULL_VALUE = 2147483647
+# Size (m) of the square CCAR tiles that river snapping KD-trees are built on
+RIVER_TILE_SIZE = 50000
+# Largest raster window (bytes) read whole when sampling many coordinates
+RASTER_READ_MAX_BYTES = 512 * 1024 ** 2
+# Most idle datasets kept open for each descriptor tif (see _open_raster)
+RASTER_HANDLES_PER_FILE = 2
+
+# Holds the open CCAR dataset for each thread (see _get_ccar).
+_CCAR_LOCAL = threading.local()
+# Idle open datasets for each descriptor tif (see _open_raster).
+_RASTER_HANDLES = {}
+_RASTER_HANDLES_LOCK = threading.Lock()
+_TIF_POOL = None
+# Threads used to sample descriptor tifs, None for one per CPU (see
+# set_tif_threads).
+_TIF_THREADS = None
 
 
 class CatchmentData(object):
@@ -78,24 +90,25 @@ class CatchmentData(object):
     }
 
     # Aggregates of LCM classes used for NRFA. I.e. LCM and many classes but
-    # NRFA groups them into a smaller subset.
+    # NRFA groups them into a smaller subset. Held as frozensets as only
+    # membership matters.
     _LCM_class_aggregates = {
-        "Woodland": [
+        "Woodland": frozenset({
             "2000_11",
             "2000_21",
             "2007_1",
             "2007_2",
             "2015_1",
             "2015_2",
-        ],
-        "Arable and Horticulture": [
+        }),
+        "Arable and Horticulture": frozenset({
             "2000_41",
             "2000_42",
             "2000_43",
             "2007_3",
             "2015_3",
-        ],
-        "Grassland": [
+        }),
+        "Grassland": frozenset({
             "2000_51",
             "2000_52",
             "2000_61",
@@ -114,8 +127,8 @@ class CatchmentData(object):
             "2015_6",
             "2015_7",
             "2015_8",
-        ],
-        "Heath/Bog": [
+        }),
+        "Heath/Bog": frozenset({
             "2000_101",
             "2000_102",
             "2000_121",
@@ -127,23 +140,23 @@ class CatchmentData(object):
             "2015_9",
             "2015_10",
             "2015_11",
-        ],
-        "Bareground": [
+        }),
+        "Bareground": frozenset({
             "2000_161",
-        ],
-        "Inland Rock": [
+        }),
+        "Inland Rock": frozenset({
             "2007_14",
             "2015_12",
-        ],
-        "Water": [
+        }),
+        "Water": frozenset({
             "2000_121",
             "2000_131",
             "2007_15",
             "2007_16",
             "2015_13",
             "2015_14",
-        ],
-        "Coastal": [
+        }),
+        "Coastal": frozenset({
             "2000_181",
             "2000_191",
             "2000_201",
@@ -159,22 +172,31 @@ class CatchmentData(object):
             "2015_17",
             "2015_18",
             "2015_19",
-        ],
-        "Urban": [
+        }),
+        "Urban": frozenset({
             "2000_171",
             "2000_172",
             "2007_22",
             "2007_23",
             "2015_20",
             "2015_21",
-        ],
-        "Unknown": [
+        }),
+        "Unknown": frozenset({
             "2000_9999",
             "2007_9999",
             "2015_9999",
-        ],
+        }),
     }
 
+    # Flat (LCM class, aggregate class) pairs built from the above, so LCM
+    # data can be matched to aggregates with a single merge. Note a LCM class
+    # can belong to more than one aggregate.
+    _LCM_class_aggregate_pairs = pd.DataFrame(
+        [(lcm_class, agg_class)
+         for agg_class, lcm_classes in _LCM_class_aggregates.items()
+         for lcm_class in lcm_classes],
+        columns=["PROPERTY_ITEM", "AGG_CLASS"])
+
     # The full names of the FEH codes
     FEH_code_map = {
         "CCAR": "ihdtm-catchment-area",
@@ -218,6 +240,27 @@ class CatchmentData(object):
         "RMD3": "ddf-d3",
     }
 
+    # Methods to fetch each of the descriptor types, used by get_data.
+    _desc_type_getters = {
+        "FEH": lambda self: self.get_FEH_data(),
+        "LCM2000": lambda self: self.get_LCM_data(2000),
+        "LCM2007": lambda self: self.get_LCM_data(2007),
+        "LCM2015": lambda self: self.get_LCM_data(2015),
+    }
+
+    # Methods to fetch each of the descriptor types for many catchments at
+    # once, used by batch_data.
+    _batch_desc_type_getters = {
+        "FEH": lambda cls, coords, stations: cls.batch_FEH_data(
+            coords, stations=stations),
+        "LCM2000": lambda cls, coords, stations: cls.batch_LCM_data(
+            coords, 2000, stations=stations),
+        "LCM2007": lambda cls, coords, stations: cls.batch_LCM_data(
+            coords, 2007, stations=stations),
+        "LCM2015": lambda cls, coords, stations: cls.batch_LCM_data(
+            coords, 2015, stations=stations),
+    }
+
     def __init__(self, easting, northing, station="", snap_to_river=False):
         self.easting_raw = easting
         self.northing_raw = northing
@@ -243,10 +286,14 @@ class CatchmentData(object):
         self._valid_LCM_years = [2000, 2007, 2015]
 
     def _river_snapping(self):
-        cell_dict = closest_ccar_above_val(self.easting_raw,
-                                           self.northing_raw,
-                                           min_ccar=200,
-                                           max_depths=20)
+        # Round easting and northing to the closest 50m
+        easting = base_round(self.easting_raw, 50)
+        northing = base_round(self.northing_raw, 50)
+
+        # Read the whole search area once, then search it in memory.
+        arr = _read_ccar_window(easting, northing, 20, _get_ccar())
+        cell_dict = closest_ccar_above_val_array(arr, easting, northing,
+                                                 min_ccar=200)
         if cell_dict is None:
             raise UserWarning("No cell found close enough for river snapping")
 
@@ -260,29 +307,10 @@ class CatchmentData(object):
     def _get_region(self):
         """
         Work out if coordinates are for Great Britian (GB) or Northern Ireland
-        (NI). Do this by checking if the fall within one of the two bounding
-        boxes that cover NI. If not, assume GB.
-
-        Bounding boxes are defined as [x_min,y_min,x_max,y_max]
+        (NI). See get_region.
 
         """
-        # West and east bounding boxes for NI
-        west_ni = [000000, 469190, 143723, 614827]
-        east_ni = [143723, 469190, 185797, 597050]
-
-        region = "gb"
-
-        # Test west bounding box
-        if self.easting >= west_ni[0] and self.easting <= west_ni[2]:
-            if self.northing >= west_ni[1] and self.northing <= west_ni[3]:
-                region = "ni"
-
-        # Test east bounding box
-        elif self.easting >= east_ni[0] and self.easting <= east_ni[2]:
-            if self.northing >= east_ni[1] and self.northing <= east_ni[3]:
-                region = "ni"
-
-        return region
+        return get_region(self.easting, self.northing)
 
     def _read_directory_tifs(self, directory, desc_type):
         """
@@ -290,69 +318,128 @@ class CatchmentData(object):
         a particluar catchment descriptor. For each, establish the descriptor
         type (PROPERTY_ITEM) and extract the value for it at the class
         coordinates.
-        Append all the values (and their type) to a dataframe.
+        Collect all the values (and their type) in a dataframe.
 
         """
-        # Create a pandas dataframe to hold the data.
-        df = pd.DataFrame(columns=['PROPERTY_ITEM', 'PROPERTY_VALUE'])
-        for dir_path, dir_name_list, file_name_list in os.walk(directory):
-            for filename in file_name_list:
-                # If this is not a tif file.
-                if not filename.endswith('.tif'):
-                    # Skip it
-                    continue
-
-                # Open the tif file.
-                file_path = os.path.join(dir_path, filename)
-                raster_file = rasterio.open(file_path)
-
-                if desc_type == "FEH":
-                    # Get the descriptor code (from filename).
-                    descriptor_code = str(filename[-11:-7])
-                elif desc_type == "LCM":
-                    lcm_year = str(filename.split("_")[1])
-                    lcm_code = str(filename.split("_")[2])[:-4]
-                    descriptor_code = lcm_year + "_" + lcm_code
-
-                # Use the class coordinates and get the value of raster.
-                val = list(raster_file.sample([
-                    (self.easting, self.northing)]))[0][0]
-
-                # Create a list to use to append the data to the dataframe.
-                values_list = [descriptor_code, val]
-                # Make a series to make a row.
-                value_series = pd.Series(values_list, index=df.columns)
-                df = df.append(value_series, ignore_index=True)
-                raster_file.close()
-
-        # Make sure values are floats
-        df["PROPERTY_VALUE"] = df["PROPERTY_VALUE"].astype(float)
+        codes, vals = _sample_directory_tifs(directory, desc_type,
+                                             self.easting, self.northing)
 
-        return df
+        # Create a pandas dataframe to hold the data. The values are copied
+        # as the cached array is shared.
+        return pd.DataFrame({'PROPERTY_ITEM': list(codes),
+                             'PROPERTY_VALUE': vals.copy()})
 
-    def _add_db_columns(self, desc_df, group="", method="", comment="",
+    @staticmethod
+    def _add_db_columns(desc_df, station="", group="", method="", comment="",
                         title="", units="", source="", remove_errors=True):
         """
         Restructure dataframe to have columns required for DB table.
 
         """
         if remove_errors:
-            desc_df = desc_df[desc_df["PROPERTY_VALUE"] > -5000]
-
-        desc_df["STATION"] = self.station
-        desc_df["PROPERTY_GROUP"] = group
-        desc_df["PROPERTY_METHOD"] = method
-        desc_df["PROPERTY_COMMENT"] = comment
-        desc_df["TITLE"] = title
-        desc_df["UNITS"] = units
-        desc_df["SOURCE_VALUE"] = source
-
-        # Arrange column order.
-        return desc_df[["STATION", "PROPERTY_GROUP", "PROPERTY_ITEM",
-                        "PROPERTY_VALUE", "PROPERTY_METHOD",
-                        "PROPERTY_COMMENT", "TITLE", "UNITS", "SOURCE_VALUE"]]
-
-    def _aggregate_LCM_classes(self, LCM_data, year):
+            # Only filter (which copies the frame) if there are errors.
+            valid = desc_df["PROPERTY_VALUE"] > -5000
+            if not valid.all():
+                desc_df = desc_df[valid]
+
+        # Build the frame in DB column order in one go, rather than adding
+        # columns then selecting them in order (which copies the frame).
+        return pd.DataFrame({
+            "STATION": station,
+            "PROPERTY_GROUP": group,
+            "PROPERTY_ITEM": desc_df["PROPERTY_ITEM"],
+            "PROPERTY_VALUE": desc_df["PROPERTY_VALUE"],
+            "PROPERTY_METHOD": method,
+            "PROPERTY_COMMENT": comment,
+            "TITLE": title,
+            "UNITS": units,
+            "SOURCE_VALUE": source,
+        }, index=desc_df.index, columns=DB_COLUMNS)
+
+    @staticmethod
+    def _batch_coords(coords, stations, snap_to_river):
+        """
+        Set up the coordinates and stations given to the batch methods, as an
+        array of (easting, northing) rows and an array of stations.
+
+        With snap_to_river the coordinates are snapped to the nearest river
+        (see snap_coords_to_river). Catchments with no river cell close enough
+        are reported and left out, rather than failing the whole batch.
+
+        """
+        xy = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+        if stations is None:
+            stations = [""] * len(xy)
+        stations = np.asarray(stations, dtype=object)
+
+        if snap_to_river:
+            eastings, northings, snapped = snap_coords_to_river(
+                xy[:, 0], xy[:, 1], raise_on_missing=False)
+            if not snapped.all():
+                print("No cell found close enough for river snapping for "
+                      "catchments: %s" % ", ".join(
+                          "%s (%s, %s)" % (station, easting, northing)
+                          for station, (easting, northing)
+                          in zip(stations[~snapped], xy[~snapped])))
+            xy = np.column_stack((eastings, northings))[snapped].astype(
+                np.float64)
+            stations = stations[snapped]
+
+        return xy, stations
+
+    @staticmethod
+    def _LCM_areas(LCM_data, catchments):
+        """
+        Work out the area (in square km) of each LCM class, and the total area
+        of its catchment, for LCM data holding the catchments given by the
+        catchments array (one label per row).
+
+        Each catchment's areas are summed in row order with the same numpy
+        reduction as Series.sum, which get_LCM_data uses, so batch_LCM_data
+        gives exactly the same percentages. (A groupby sum adds them in a
+        different order, changing the last bits.)
+
+        Returns series of the class and catchment areas, one value per row.
+
+        """
+        # Divide by 400 to get the area in square km.
+        areas = LCM_data["PROPERTY_VALUE"] / 400.
+
+        # Gather each catchment's areas (in row order) next to each other,
+        # then sum each run of them.
+        order = np.argsort(catchments, kind="stable")
+        sorted_areas = areas.to_numpy()[order]
+        sorted_catchments = np.asarray(catchments)[order]
+        starts = np.flatnonzero(np.concatenate((
+            [True], sorted_catchments[1:] != sorted_catchments[:-1])))
+        stops = np.append(starts[1:], len(sorted_areas))
+        totals = np.array([sorted_areas[start:stop].sum() for start, stop
+                           in zip(starts.tolist(), stops.tolist())],
+                          dtype=np.float64)
+
+        catchment_areas = np.empty(len(areas), dtype=np.float64)
+        catchment_areas[order] = np.repeat(totals, stops - starts)
+
+        return areas, pd.Series(catchment_areas, index=areas.index)
+
+    @classmethod
+    def _convert_FEH_codes(cls, FEH_data):
+        """
+        Swap the FEH codes in PROPERTY_ITEM for their full names. Codes
+        without a full name are kept.
+        The codes are made categorical first, so each distinct code is only
+        looked up once rather than once per row (per station in a batch).
+
+        """
+        item_dtype = FEH_data["PROPERTY_ITEM"].dtype
+        codes = FEH_data["PROPERTY_ITEM"].astype("category")
+        FEH_data["PROPERTY_ITEM"] = codes.map(
+            lambda code: cls.FEH_code_map.get(code, code)).astype(item_dtype)
+
+        return FEH_data
+
+    @classmethod
+    def _aggregate_LCM_classes(cls, LCM_data, year, catchments=None):
         """
         LCM data has a set of classes, e.g. Improved grassland and Neutral
         grassland, with assciated codes (which can vary between years). For
@@ -360,43 +447,65 @@ class CatchmentData(object):
         classes, e.g. Grassland, which includes both 'Improved' and 'Neutral'.
 
         The mapping between the simplied classes and the LCM class codes is
-        given in the dictionary self._LCM_class_aggregates.
+        given in the dictionary cls._LCM_class_aggregates.
+
+        LCM_data can hold several catchments, given by the catchments array
+        (one label per row), in which case each is aggregated separately and
+        its aggregate rows follow its LCM rows.
 
         """
         group = "lcm%snrfav2021" % year
-
-        for agg_class, lcm_classes in self._LCM_class_aggregates.items():
-            # Extract details from the LCM classes within the aggregate class
-            valid_classes = LCM_data[
-                LCM_data["PROPERTY_ITEM"].isin(lcm_classes)]
-
-            if len(valid_classes) == 0:
-                continue
-
-            # LCM classes have format 'year_class', extract just the class
-            # numbers so we can create a sting for teh SOURCE_VALUE column
-            valid_cls_nums = [cls.split("_")[-1]
-                              for cls in valid_classes["PROPERTY_ITEM"]]
-            source = "+".join(valid_cls_nums)
-
-            # Sum the total percentage across aggregate classes
-            agg_total = valid_classes["PROPERTY_VALUE"].sum()
-
-            new_row = {
-                "STATION": self.station,
-                "PROPERTY_GROUP": group,
-                "PROPERTY_ITEM": agg_class,
-                "PROPERTY_VALUE": agg_total,
-                "PROPERTY_METHOD": "automatic",
-                "PROPERTY_COMMENT": "",
-                "TITLE": agg_class,
-                "UNITS": "proportion",
-                "SOURCE_VALUE": source
-            }
-
-            LCM_data = LCM_data.append(new_row, ignore_index=True)
-
-        return LCM_data
+        if catchments is None:
+            catchments = np.zeros(len(LCM_data), dtype=np.int64)
+
+        # Match LCM classes to the aggregate classes they are within
+        agg_data = LCM_data[["STATION", "PROPERTY_ITEM", "PROPERTY_VALUE"]]\
+            .assign(CATCHMENT=catchments)\
+            .merge(cls._LCM_class_aggregate_pairs, on="PROPERTY_ITEM")
+
+        if len(agg_data) == 0:
+            return LCM_data
+
+        # LCM classes have format 'year_class', extract just the class
+        # numbers so we can create a sting for teh SOURCE_VALUE column.
+        # Done on the categories, so once per class rather than once per row.
+        lcm_classes = agg_data["PROPERTY_ITEM"].astype("category")
+        class_nums = lcm_classes.cat.categories.str.split("_").str[-1]
+        agg_data["CLASS_NUM"] = class_nums.take(lcm_classes.cat.codes)
+
+        # Sum the total percentage across aggregate classes, for all
+        # catchments in one groupby.
+        aggs = agg_data.groupby(["CATCHMENT", "AGG_CLASS"], sort=False).agg(
+            STATION=("STATION", "first"),
+            PROPERTY_VALUE=("PROPERTY_VALUE", "sum"),
+            SOURCE_VALUE=("CLASS_NUM", "+".join)).reset_index()
+
+        new_rows = pd.DataFrame({
+            "STATION": aggs["STATION"].to_numpy(),
+            "PROPERTY_GROUP": group,
+            "PROPERTY_ITEM": aggs["AGG_CLASS"].to_numpy(),
+            "PROPERTY_VALUE": aggs["PROPERTY_VALUE"].to_numpy(),
+            "PROPERTY_METHOD": "automatic",
+            "PROPERTY_COMMENT": "",
+            "TITLE": aggs["AGG_CLASS"].to_numpy(),
+            "UNITS": "proportion",
+            "SOURCE_VALUE": aggs["SOURCE_VALUE"].to_numpy(),
+        })
+
+        # Order rows by catchment, with each catchment's LCM rows (in their
+        # original order) before its aggregate classes, which are in the
+        # order they are defined.
+        agg_rank = {agg_class: rank for rank, agg_class
+                    in enumerate(cls._LCM_class_aggregates)}
+        row_catchments = np.concatenate([np.asarray(catchments),
+                                         aggs["CATCHMENT"].to_numpy()])
+        row_ranks = np.concatenate([
+            np.full(len(LCM_data), -1),
+            aggs["AGG_CLASS"].map(agg_rank).to_numpy()])
+        order = np.lexsort((row_ranks, row_catchments))
+
+        return pd.concat([LCM_data, new_rows],
+                         ignore_index=True).take(order).reset_index(drop=True)
 
     def get_FEH_data(self, convert_codes=False):
         """
@@ -419,14 +528,77 @@ class CatchmentData(object):
             FEH_data = self._read_directory_tifs(desc_dir, "FEH")
 
             if convert_codes is True:
-                FEH_data = FEH_data.replace(self.FEH_code_map)
+                FEH_data = self._convert_FEH_codes(FEH_data)
 
             self.FEH_data = self._add_db_columns(FEH_data,
+                                                 station=self.station,
                                                  group="FEH",
                                                  method="automatic")
 
         return self.FEH_data
 
+    @classmethod
+    def batch_FEH_data(cls, coords, stations=None, convert_codes=False,
+                       snap_to_river=False):
+        """
+        Extract FEH data for many catchments at once. Each tif is opened once
+        and sampled at all the coordinates in a single call, rather than once
+        per catchment.
+
+        Args:
+            coords: list
+                (easting, northing) tuples, one per catchment.
+            stations: list
+                Optional station IDs, in the same order as coords.
+            convert_codes: Bool
+                Optionally convert FEH codes to their full names.
+            snap_to_river: Bool
+                Shift the coordinates to the nearest river first (see
+                snap_coords_to_river).
+
+        Returns a dataframe in the same format as get_FEH_data, covering all
+        the catchments in the order given (catchments that can't be snapped
+        to the river are left out).
+
+        """
+        xy, stations = cls._batch_coords(coords, stations, snap_to_river)
+        regions = get_regions(xy[:, 0], xy[:, 1])
+
+        catchment_col = []
+        station_col = []
+        codes = []
+        vals = []
+        for region in np.unique(regions):
+            region_idxs = np.flatnonzero(regions == region)
+            region_xy = xy[region_idxs]
+
+            desc_dir = cls._descriptor_type_dirs["FEH_%s" % region]
+            tifs = _list_tifs(desc_dir, "FEH")
+            vals.extend(_sample_tifs(tifs, region_xy))
+            for file_path, descriptor_code in tifs:
+                catchment_col.extend(region_idxs)
+                station_col.extend(stations[region_idxs])
+                codes.extend([descriptor_code] * len(region_idxs))
+
+        # Group the rows by catchment, each in tif order as get_FEH_data
+        # gives them.
+        order = np.argsort(np.asarray(catchment_col, dtype=np.int64),
+                           kind="stable")
+        FEH_data = pd.DataFrame({
+            "STATION": np.asarray(station_col, dtype=object)[order],
+            "PROPERTY_ITEM": np.asarray(codes, dtype=object)[order],
+            "PROPERTY_VALUE": np.concatenate(vals)[order] if vals else
+            np.array([], dtype=np.float64),
+        })
+
+        if convert_codes is True:
+            FEH_data = cls._convert_FEH_codes(FEH_data)
+
+        return cls._add_db_columns(FEH_data,
+                                   station=FEH_data["STATION"],
+                                   group="FEH",
+                                   method="automatic")
+
     def get_LCM_data(self, year=2015):
         """
         Extract land cover map (LCM) data for catchment, specifying the LCM
@@ -468,26 +640,117 @@ class CatchmentData(object):
             group = "lcm%sv2021" % year
             source = LCM_data["PROPERTY_ITEM"]
             LCM_data = self._add_db_columns(LCM_data,
+                                            station=self.station,
                                             group=group,
                                             method="automatic",
                                             units="proportion",
                                             source=source)
 
             # Divide by 400 to get the area in square km.
-            LCM_data["PROPERTY_VALUE"] = LCM_data["PROPERTY_VALUE"] / 400.
-            # Get the sum of area.
-            catchment_area = LCM_data["PROPERTY_VALUE"].sum()
-            # Calculate the percentage of each category.
-            LCM_data["PROPERTY_VALUE"] = (
-                LCM_data["PROPERTY_VALUE"] / catchment_area) * 100.
+            areas = LCM_data["PROPERTY_VALUE"] / 400.
+            catchment_area = areas.sum()
+            if catchment_area == 0:
+                # No land cover to take percentages of (e.g. all cells had
+                # errors), rather than dividing by zero return no rows.
+                print("No LCM %s land cover found for catchment %s"
+                      % (year, self.station))
+                LCM_data = LCM_data.iloc[:0]
+            else:
+                # Calculate the percentage of each category, written back to
+                # the frame once.
+                LCM_data["PROPERTY_VALUE"] = (areas / catchment_area) * 100.
 
-            # Join LCM classes into simplified classes
-            LCM_data = self._aggregate_LCM_classes(LCM_data, year)
+                # Join LCM classes into simplified classes
+                LCM_data = self._aggregate_LCM_classes(LCM_data, year)
 
             setattr(self, attr, LCM_data)
 
         return LCM_data
 
+    @classmethod
+    def batch_LCM_data(cls, coords, year=2015, stations=None,
+                       snap_to_river=False):
+        """
+        Extract land cover map (LCM) data for many catchments at once, as
+        batch_FEH_data does for FEH data. Each tif is opened once and sampled
+        at all the coordinates in a single call.
+
+        Args:
+            coords: list
+                (easting, northing) tuples, one per catchment.
+            year: int
+                LCM version.
+            stations: list
+                Optional station IDs, in the same order as coords.
+            snap_to_river: Bool
+                Shift the coordinates to the nearest river first (see
+                snap_coords_to_river).
+
+        Returns a dataframe in the same format as get_LCM_data, covering all
+        the catchments in the order given (catchments that can't be snapped
+        to the river are left out).
+
+        """
+        xy, stations = cls._batch_coords(coords, stations, snap_to_river)
+        regions = get_regions(xy[:, 0], xy[:, 1])
+
+        catchment_col = []
+        station_col = []
+        codes = []
+        vals = []
+        for region in np.unique(regions):
+            region_idxs = np.flatnonzero(regions == region)
+            region_xy = xy[region_idxs]
+
+            desc_dir = cls._descriptor_type_dirs.get(
+                "LCM_%s_%s" % (year, region))
+            if desc_dir is None:
+                raise UserWarning("Invalid year: %s. Valid years are: 2000, "
+                                  "2007, 2015" % year)
+
+            tifs = _list_tifs(desc_dir, "LCM")
+            vals.extend(_sample_tifs(tifs, region_xy))
+            for file_path, descriptor_code in tifs:
+                catchment_col.extend(region_idxs)
+                station_col.extend(stations[region_idxs])
+                codes.extend([descriptor_code] * len(region_idxs))
+
+        LCM_data = pd.DataFrame({
+            "STATION": station_col,
+            "PROPERTY_ITEM": codes,
+            "PROPERTY_VALUE": np.concatenate(vals) if vals else np.array(
+                [], dtype=np.float64),
+        })
+
+        group = "lcm%sv2021" % year
+        LCM_data = cls._add_db_columns(LCM_data,
+                                       station=LCM_data["STATION"],
+                                       group=group,
+                                       method="automatic",
+                                       units="proportion",
+                                       source=LCM_data["PROPERTY_ITEM"])
+        catchments = np.asarray(catchment_col, dtype=np.int64)[LCM_data.index]
+        areas, catchment_areas = cls._LCM_areas(LCM_data, catchments)
+
+        # Drop catchments with no land cover to take percentages of, rather
+        # than dividing by zero.
+        has_area = (catchment_areas != 0).to_numpy()
+        if not has_area.all():
+            print("No LCM %s land cover found for catchments: %s" % (
+                year, ", ".join(str(stations[catchment]) for catchment
+                                in np.unique(catchments[~has_area]))))
+            LCM_data = LCM_data[has_area]
+            areas = areas[has_area]
+            catchment_areas = catchment_areas[has_area]
+            catchments = catchments[has_area]
+
+        # Calculate the percentage of each category, within each catchment.
+        LCM_data["PROPERTY_VALUE"] = (areas / catchment_areas) * 100.
+
+        # Join LCM classes into simplified classes, within each catchment
+        return cls._aggregate_LCM_classes(LCM_data, year,
+                                          catchments=catchments)
+
     def get_data(self, desc_types="all", savepath=None):
         """
         Extract catchment data and convert to format for database.
@@ -507,46 +770,337 @@ class CatchmentData(object):
                                       ))
 
         # Fetch given descriptor types, convert to DB format and combine.
-        descs_df = None
+        descs_df = pd.concat([self._desc_type_getters[desc_type](self)
+                              for desc_type in desc_types],
+                             ignore_index=True)
+
+        if savepath is not None:
+            descs_df.to_csv(savepath, index=False)
+
+        return descs_df
+
+    @classmethod
+    def _check_desc_types(cls, desc_types):
+        """
+        Check the descriptor types given to batch_data are valid, raising a
+        UserWarning if not.
+
+        Returns them as a list, with "all" expanded.
+
+        """
+        if isinstance(desc_types, str):
+            desc_types = [desc_types]
+        if desc_types[0] == "all":
+            return list(cls._batch_desc_type_getters)
+
         for desc_type in desc_types:
-            if desc_type == "FEH":
-                self.get_FEH_data()
-                if descs_df is None:
-                    descs_df = self.FEH_data
-                else:
-                    descs_df = descs_df.append(self.FEH_data,
-                                               ignore_index=True)
-
-            elif desc_type == "LCM2000":
-                self.get_LCM_data(2000)
-                if descs_df is None:
-                    descs_df = self.LCM_2000_data
-                else:
-                    descs_df = descs_df.append(self.LCM_2000_data,
-                                               ignore_index=True)
-
-            elif desc_type == "LCM2007":
-                self.get_LCM_data(2007)
-                if descs_df is None:
-                    descs_df = self.LCM_2007_data
-                else:
-                    descs_df = descs_df.append(self.LCM_2007_data,
-                                               ignore_index=True)
-
-            elif desc_type == "LCM2015":
-                self.get_LCM_data(2015)
-                if descs_df is None:
-                    descs_df = self.LCM_2015_data
-                else:
-                    descs_df = descs_df.append(self.LCM_2015_data,
-                                               ignore_index=True)
+            if desc_type not in cls._batch_desc_type_getters:
+                raise UserWarning("Invalid descriptor type: %s. Valid "
+                                  "descriptor types are: %s" % (
+                                      desc_type,
+                                      ", ".join(cls._batch_desc_type_getters)
+                                  ))
+
+        return list(desc_types)
+
+    @classmethod
+    def batch_data(cls, coords, desc_types="all", stations=None,
+                   snap_to_river=False, savepath=None):
+        """
+        Extract catchment data for many catchments at once and convert to
+        format for database, as get_data does for one. Each descriptor type
+        is extracted with its batch method (batch_FEH_data, batch_LCM_data).
+
+        Args:
+            coords: list
+                (easting, northing) tuples, one per catchment.
+            desc_types: str or list
+                Descriptor types to extract, see get_data.
+            stations: list
+                Optional station IDs, in the same order as coords.
+            snap_to_river: Bool
+                Shift the coordinates to the nearest river first (see
+                snap_coords_to_river), once for all the descriptor types.
+                Catchments that can't be snapped are reported and left out.
+
+        Rows are grouped by descriptor type, then by catchment.
+
+        """
+        desc_types = cls._check_desc_types(desc_types)
+        xy, stations = cls._batch_coords(coords, stations, snap_to_river)
+
+        # Fetch given descriptor types, already in DB format, and combine.
+        descs_df = pd.concat([
+            cls._batch_desc_type_getters[desc_type](cls, xy, stations)
+            for desc_type in desc_types], ignore_index=True)
 
         if savepath is not None:
-            descs_df.to_csv(savepath)
+            descs_df.to_csv(savepath, index=False)
 
         return descs_df
 
 
+def get_region(easting, northing):
+    """
+    Work out if coordinates are for Great Britian (GB) or Northern Ireland
+    (NI). Do this by checking if the fall within one of the two bounding
+    boxes that cover NI. If not, assume GB.
+
+    """
+    return str(get_regions([easting], [northing])[0])
+
+
+def get_regions(eastings, northings):
+    """
+    As get_region, but for arrays of coordinates. All coordinates are tested
+    against both NI bounding boxes at once.
+
+    Returns an array of "gb" / "ni" strings.
+
+    """
+    eastings = np.asarray(eastings)[:, None]
+    northings = np.asarray(northings)[:, None]
+
+    inside = ((eastings >= NI_BOUNDING_BOXES[:, 0]) &
+              (eastings <= NI_BOUNDING_BOXES[:, 2]) &
+              (northings >= NI_BOUNDING_BOXES[:, 1]) &
+              (northings <= NI_BOUNDING_BOXES[:, 3])).any(axis=1)
+
+    return np.where(inside, "ni", "gb")
+
+
+@functools.lru_cache(maxsize=None)
+def _list_tifs(directory, desc_type):
+    """
+    List the tif files in the given directory along with the descriptor code
+    for each, taken from the filename. Cached so each directory is only walked
+    once, however many catchments are processed.
+
+    """
+    tifs = []
+    for dir_path, dir_name_list, file_name_list in os.walk(directory):
+        for filename in file_name_list:
+            if desc_type == "FEH":
+                match = FEH_TIF_RE.search(filename)
+            elif desc_type == "LCM":
+                match = LCM_TIF_RE.search(filename)
+
+            # If this is not a descriptor tif file.
+            if match is None:
+                # Skip it
+                continue
+
+            # Get the descriptor code (from filename).
+            descriptor_code = "_".join(match.groups())
+            tifs.append((os.path.join(dir_path, filename), descriptor_code))
+
+    return tuple(tifs)
+
+
+@functools.lru_cache(maxsize=4096)
+def _sample_directory_tifs(directory, desc_type, easting, northing):
+    """
+    Sample each descriptor tif in the given directory at the coordinates.
+    Cached, so catchments at the same coordinates (e.g. sites snapped to the
+    same river cell) are only sampled once.
+
+    Returns a tuple of the descriptor codes and a read-only array of their
+    values.
+
+    """
+    tifs = _list_tifs(directory, desc_type)
+    coords = [(easting, northing)]
+
+    def sample_tif(file_path):
+        # Use the coordinates and get the value of raster.
+        with _open_raster(file_path) as raster_file:
+            return next(raster_file.sample(coords))[0]
+
+    # Sample the tifs across the thread pool so the reads overlap.
+    codes = tuple(descriptor_code for _, descriptor_code in tifs)
+    vals = np.fromiter(
+        _get_tif_pool().map(sample_tif, [path for path, _ in tifs]),
+        dtype=np.float64, count=len(tifs))
+    vals.flags.writeable = False
+
+    return codes, vals
+
+
+@contextlib.contextmanager
+def _open_raster(file_path):
+    """
+    Open a raster file, for use in a with statement. Once finished with, the
+    dataset is kept for the next use of the file, so datasets are reused
+    across catchments rather than reopened for each.
+
+    A dataset is only used by one thread at a time, as rasterio datasets must
+    not be shared between threads, but it is not tied to a thread. At most
+    RASTER_HANDLES_PER_FILE are kept for each file, so the number of open
+    files follows the number of tifs rather than tifs times threads.
+
+    """
+    with _RASTER_HANDLES_LOCK:
+        idle = _RASTER_HANDLES.get(file_path)
+        raster_file = idle.pop() if idle else None
+
+    if raster_file is None:
+        # Let GDAL decode the blocks of multi-block reads (e.g. the windows
+        # read by _sample_raster) in parallel. Single cell reads are
+        # unaffected.
+        raster_file = rasterio.open(file_path, sharing=False,
+                                    num_threads=_TIF_THREADS or "ALL_CPUS")
+
+    try:
+        yield raster_file
+    finally:
+        with _RASTER_HANDLES_LOCK:
+            idle = _RASTER_HANDLES.setdefault(file_path, [])
+            if len(idle) < RASTER_HANDLES_PER_FILE:
+                idle.append(raster_file)
+                raster_file = None
+        if raster_file is not None:
+            raster_file.close()
+
+
+@atexit.register
+def _close_rasters():
+    """
+    Close the idle datasets kept by _open_raster.
+
+    """
+    with _RASTER_HANDLES_LOCK:
+        for idle in _RASTER_HANDLES.values():
+            for raster_file in idle:
+                raster_file.close()
+        _RASTER_HANDLES.clear()
+
+
+def _raster_cells(transform, xy):
+    """
+    Convert each (easting, northing) row of xy to the (row, col) of the
+    raster cell it falls in, for a raster with the given transform.
+
+    Returns arrays of the rows and cols.
+
+    """
+    rows, cols = rowcol(transform, xy[:, 0], xy[:, 1])
+    return np.asarray(rows), np.asarray(cols)
+
+
+def _sample_raster(raster_file, rows, cols):
+    """
+    Sample the first band of the raster at each (row, col) cell (see
+    _raster_cells), as raster_file.sample does at the matching coordinates.
+    Where the window covering the cells is smaller than the blocks sampling
+    would read (and under RASTER_READ_MAX_BYTES), it is read in one go and
+    indexed. Otherwise cells are read in (row, col) order, so consecutive
+    reads fall in the same GeoTIFF blocks and are served from GDAL's block
+    cache.
+
+    Returns a float array of the values.
+
+    """
+    inside = ((rows >= 0) & (rows < raster_file.height) &
+              (cols >= 0) & (cols < raster_file.width))
+    # Cells off the raster get the same fill value sample gives.
+    vals = np.full(len(rows), raster_file.nodata or 0,
+                   dtype=raster_file.dtypes[0]).astype(np.float64)
+    if not inside.any():
+        return vals
+
+    row_min = int(rows[inside].min())
+    col_min = int(cols[inside].min())
+    height = int(rows[inside].max()) - row_min + 1
+    width = int(cols[inside].max()) - col_min + 1
+    block_height, block_width = raster_file.block_shapes[0]
+    item_size = np.dtype(raster_file.dtypes[0]).itemsize
+
+    if (height * width * item_size <= RASTER_READ_MAX_BYTES and
+            height * width <= inside.sum() * block_height * block_width):
+        arr = raster_file.read(1, window=Window(col_min, row_min,
+                                                width, height))
+        vals[inside] = arr[rows[inside] - row_min, cols[inside] - col_min]
+        return vals
+
+    for i in np.flatnonzero(inside)[np.lexsort((cols[inside],
+                                                rows[inside]))].tolist():
+        vals[i] = raster_file.read(
+            1, window=Window(int(cols[i]), int(rows[i]), 1, 1))[0, 0]
+
+    return vals
+
+
+def _sample_tifs(tifs, xy):
+    """
+    Sample each of the tifs (as listed by _list_tifs) at every (easting,
+    northing) row of xy. The tifs are sampled across the thread pool, and
+    tifs on the same grid share their cell positions (see _raster_cells).
+
+    Returns a list of float arrays of the values, one per tif.
+
+    """
+    grid_cells = {}
+
+    def sample_tif(file_path):
+        with _open_raster(file_path) as raster_file:
+            cells = grid_cells.get(raster_file.transform)
+            if cells is None:
+                cells = _raster_cells(raster_file.transform, xy)
+                grid_cells[raster_file.transform] = cells
+            return _sample_raster(raster_file, *cells)
+
+    return list(_get_tif_pool().map(sample_tif,
+                                    [file_path for file_path, _ in tifs]))
+
+
+def _get_tif_pool():
+    """
+    Return the thread pool used to sample descriptor tifs. Created on first
+    use and kept for later calls.
+
+    """
+    global _TIF_POOL
+    if _TIF_POOL is None:
+        _TIF_POOL = ThreadPoolExecutor(
+            max_workers=_TIF_THREADS or os.cpu_count())
+        atexit.register(_TIF_POOL.shutdown)
+
+    return _TIF_POOL
+
+
+def set_tif_threads(threads):
+    """
+    Set the number of threads used to sample descriptor tifs, for both the
+    thread pool and GDAL's block decoding (by default one per CPU). For
+    worker processes sharing the CPUs, so each only uses its share. Set
+    before any tifs are sampled.
+
+    """
+    global _TIF_POOL, _TIF_THREADS
+    _TIF_THREADS = threads
+    if _TIF_POOL is not None:
+        _TIF_POOL.shutdown()
+        _TIF_POOL = None
+
+
+def _reset_after_fork():
+    """
+    Drop the thread pool and open datasets inherited by a forked process. The
+    pool's threads do not survive the fork and the datasets' file handles are
+    shared with the parent, so the child opens its own as needed.
+
+    """
+    global _CCAR_LOCAL, _RASTER_HANDLES, _RASTER_HANDLES_LOCK, _TIF_POOL
+    _CCAR_LOCAL = threading.local()
+    _RASTER_HANDLES = {}
+    _RASTER_HANDLES_LOCK = threading.Lock()
+    _TIF_POOL = None
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
 def get_QCN_data(stations):
     """
     Create QCN (Polygon centroids) Dataset.
@@ -558,50 +1112,53 @@ def get_QCN_data(stations):
     coordinated directly from ArcGIS).
 
     """
-    qcn_data = pd.read_csv(paths.QCN_DIR + "catchments_all.csv")
-    qcn_data = qcn_stations_df[qcn_data["STATION"].isin(stations)]
+    qcn_data = pd.read_csv(paths.QCN_DIR + "catchments_all.csv",
+                           engine=CSV_ENGINE)
+    qcn_data = qcn_data[qcn_data["STATION"].isin(stations)]
+
+    # Centroids are written as integers, so leave out stations missing one
+    # rather than writing a meaningless value.
+    missing = qcn_data[["QCNE", "QCNN"]].isna().any(axis=1)
+    if missing.any():
+        print("No QCN centroid for stations: %s" % ", ".join(
+            qcn_data.loc[missing, "STATION"].astype(str)))
+        qcn_data = qcn_data[~missing]
+
     if len(qcn_data) == 0:
         print("No valid QCN station IDs given")
         return
 
     print("Creating QCN (Polygon centroids) dataset *************************")
-    qcndf = pd.DataFrame(
-        columns=["STATION", "PROPERTY_ITEM", "PROPERTY_VALUE"])
-
-    for index, row in qcn_data.iterrows():
-        station_name = row["STATION"]
-        QCNE = int(row["QCNE"])
-        QCNN = int(row["QCNN"])
-        list_qcne = [station_name, "QCNE", QCNE]
-        list_qcnn = [station_name, "QCNN", QCNN]
-
-        # Make a series per row
-        value_series_qcne = pd.Series(list_qcne, index=qcndf.columns)
-        value_series_qcnn = pd.Series(list_qcnn, index=qcndf.columns)
+    # A QCNE then a QCNN row for each station, built column by column, with
+    # columns to match NRFA Oracle table.
+    return pd.DataFrame({
+        "STATION": qcn_data["STATION"].repeat(2).to_numpy(),
+        "PROPERTY_GROUP": "FEH",
+        "PROPERTY_ITEM": ["QCNE", "QCNN"] * len(qcn_data),
+        "PROPERTY_VALUE": qcn_data[["QCNE", "QCNN"]].to_numpy().astype(
+            np.int64).ravel(),
+        "PROPERTY_METHOD": "automatic",
+        "PROPERTY_COMMENT": "",
+        "TITLE": "",
+        "UNITS": "",
+        "SOURCE_VALUE": "",
+    }, columns=DB_COLUMNS)
 
-        qcndf = qcndf.append(value_series_qcne, ignore_index=True)
-        qcndf = qcndf.append(value_series_qcnn, ignore_index=True)
 
-    # Add Columns to match NRFA Oracle table
-    qcndf["PROPERTY_GROUP"] = "FEH"
-    qcndf["PROPERTY_METHOD"] = "automatic"
-    qcndf["PROPERTY_COMMENT"] = ""
-    qcndf["TITLE"] = ""
-    qcndf["UNITS"] = ""
-    qcndf["SOURCE_VALUE"] = ""
+def base_round(x, base):
+    """
+    Returns a value rounded to base number.
 
-    # Rearrange columns to match Oracle table
-    return qcndf[["STATION", "PROPERTY_GROUP", "PROPERTY_ITEM",
-                  "PROPERTY_VALUE", "PROPERTY_METHOD", "PROPERTY_COMMENT",
-                  "TITLE", "UNITS", "SOURCE_VALUE"]]
+    """
+    return base * int(round(x / base))
 
 
-def base_round(x, base):
+def _base_round_arr(x, base):
     """
-    Returns a value rounded to base number.
+    As base_round, but rounds a whole array of values at once.
 
     """
-    return base * round(x / base)
+    return np.round(np.asarray(x) / base).astype(np.int64) * base
 
 
 def get_layer(easting, northing):
@@ -613,11 +1170,33 @@ def get_layer(easting, northing):
     Layer name has format: "T(easting)_(northing)"
 
     """
-    label_easting = min(LCM2015_EASTING_LAYERS, key=lambda x:abs(x-easting))
-    label_northing = min(LCM2015_NORTHING_LAYERS, key=lambda x:abs(x-northing))
+    # Layers are evenly spaced so the closest can be found directly. Halfway
+    # points go to the lower layer.
+    e_idx = ceil((easting - LCM2015_EASTING_LAYERS[0]) / 100000. - 0.5)
+    n_idx = ceil((northing - LCM2015_NORTHING_LAYERS[0]) / 100000. - 0.5)
+    e_idx = max(0, min(len(LCM2015_EASTING_LAYERS) - 1, e_idx))
+    n_idx = max(0, min(len(LCM2015_NORTHING_LAYERS) - 1, n_idx))
+
+    label_easting = LCM2015_EASTING_LAYERS[e_idx]
+    label_northing = LCM2015_NORTHING_LAYERS[n_idx]
     return "T" + str(label_easting) + "_" + str(label_northing)
 
 
+def _get_ccar():
+    """
+    Return the open CCAR dataset for this thread. The file is opened on first
+    use and then reused, rather than reopened on every read.
+
+    """
+    raster_file = getattr(_CCAR_LOCAL, "raster_file", None)
+    if raster_file is None or raster_file.closed:
+        raster_file = rasterio.open(paths.CCAR_FILE, sharing=False)
+        atexit.register(raster_file.close)
+        _CCAR_LOCAL.raster_file = raster_file
+
+    return raster_file
+
+
 def read_ccar(easting, northing, raster_file=None):
     """
     Get CCAR value from the dataset.
@@ -626,29 +1205,40 @@ def read_ccar(easting, northing, raster_file=None):
 
     """
     if raster_file is None:
-        raster_file = rasterio.open(paths.CCAR_FILE)
-        close_raster = True
-    else:
-        # If raster file is given, do not close it in this function
-        close_raster = False
+        raster_file = _get_ccar()
 
     # Round easting and northing to the closest 50m
     easting = base_round(easting, 50)
     northing = base_round(northing, 50)
 
-    # Using the rasterio.sample method to get CCAR at specific point
-    val = list(raster_file.sample([(easting, northing)]))[0][0]
+    # Read the single cell at the point directly
+    row, col = raster_file.index(easting, northing)
+    val = raster_file.read(1, window=Window(col, row, 1, 1), boundless=True,
+                           fill_value=CCAR_NULL_VALUE)[0, 0]
 
-    if close_raster:
-        raster_file.close()
-
-    if val == 2147483647:
+    if val == CCAR_NULL_VALUE:
         # Special bad value, convert to -999
         return -999
     else:
         return val
 
 
+def _read_ccar_window(easting, northing, depth, raster_file):
+    """
+    Read the square of CCAR cells around the given (rounded) easting and
+    northing, depth cells either side, as a 2D array. Row 0 is the northern
+    edge and column 0 the western edge. Cells outside the raster are given
+    CCAR_NULL_VALUE.
+
+    """
+    # Window starts at the north west corner of the square.
+    size = (2 * depth) + 1
+    row_off, col_off = raster_file.index(easting - (50 * depth),
+                                         northing + (50 * depth))
+    return raster_file.read(1, window=Window(col_off, row_off, size, size),
+                            boundless=True, fill_value=CCAR_NULL_VALUE)
+
+
 def read_ccar_square(easting, northing, depth, border_only=False,
                      raster_file=None):
     """
@@ -659,63 +1249,55 @@ def read_ccar_square(easting, northing, depth, border_only=False,
     are read, as oppose to all 9. At depth 2, the 16 cells that surround the
     central 9 are read.. and so on.
 
+    The whole square is fetched with a single windowed read rather than
+    sampling each cell separately. Cells are returned as a dictionary of
+    parallel arrays with keys "easting", "northing", "ccar" and "distance".
+
     """
-    cell_dicts = []
+    if raster_file is None:
+        raster_file = _get_ccar()
 
-    if depth == 0:
-        # Handle 0 case separately (is just the given centre cell).
-        ccar = read_ccar(easting, northing, raster_file)
-        cell_dict = {}
-        cell_dict["easting"] = easting
-        cell_dict["northing"] = northing
-        cell_dict["ccar"] = ccar
-        cell_dict["distance"] = 0
-        cell_dicts.append(cell_dict)
+    # Round easting and northing to the closest 50m
+    easting = base_round(easting, 50)
+    northing = base_round(northing, 50)
 
+    arr = _read_ccar_window(easting, northing, depth, raster_file)
+    size = (2 * depth) + 1
+
+    # Raster rows run north to south, flip and transpose so cells are ordered
+    # west to east, then south to north (the order they were read before).
+    ccars = arr[::-1].T.astype(np.int64)
+    # Special bad value, convert to -999
+    ccars[ccars == CCAR_NULL_VALUE] = -999
+
+    offsets = 50 * np.arange(-depth, depth + 1)
+    eastings, northings = np.meshgrid(easting + offsets, northing + offsets,
+                                      indexing="ij")
+    distances = np.hypot(eastings - easting, northings - northing)
+
+    if border_only is True and depth > 0:
+        # Only keep cells where easting or northing is at max or min depth.
+        keep = np.zeros((size, size), dtype=bool)
+        keep[[0, -1], :] = True
+        keep[:, [0, -1]] = True
     else:
-        if border_only is True:
-            # To pick out only the border cells, we constrain easting or
-            # northing to always be at max or min depth.
-            e_depth_range = [-depth, depth]
-        else:
-            e_depth_range = range(-depth, depth + 1)
-
-        for e_depth in e_depth_range:
-            for n_depth in range(-depth, depth + 1):
-                this_easting = easting + (50 * e_depth)
-                this_northing = northing + (50 * n_depth)
-
-                ccar = read_ccar(this_easting, this_northing, raster_file)
-                dist = sqrt((this_easting - easting)**2 +
-                            (this_northing - northing)**2)
-
-                cell_dict = {}
-                cell_dict["easting"] = this_easting
-                cell_dict["northing"] = this_northing
-                cell_dict["ccar"] = ccar
-                cell_dict["distance"] = dist
-                cell_dicts.append(cell_dict)
-
-        if border_only is True:
-            # Do remaining on cells on top and bottom borders (leaving out the
-            # corners as they are already done).
-            for n_depth in [-depth, depth]:
-                for e_depth in range(-depth + 1, depth):
-                    this_easting = easting + (50 * e_depth)
-                    this_northing = northing + (50 * n_depth)
-
-                    ccar = read_ccar(this_easting, this_northing, raster_file)
-                    dist = sqrt((this_easting - easting)**2 +
-                                (this_northing - northing)**2)
-
-                    cell_dict = {}
-                    cell_dict["easting"] = this_easting
-                    cell_dict["northing"] = this_northing
-                    cell_dict["ccar"] = ccar
-                    cell_dict["distance"] = dist
-                    cell_dicts.append(cell_dict)
-
-    return cell_dicts
+        keep = np.ones((size, size), dtype=bool)
+
+    return {
+        "easting": eastings[keep],
+        "northing": northings[keep],
+        "ccar": ccars[keep],
+        "distance": distances[keep],
+    }
+
+
+def _cell_dict(cells, idx):
+    """
+    Pick out a single cell, as a dictionary, from the arrays returned by
+    read_ccar_square.
+
+    """
+    return {key: values[idx].item() for key, values in cells.items()}
 
 
 def largest_ccar_close_by(easting, northing, depth=1):
@@ -733,30 +1315,99 @@ def largest_ccar_close_by(easting, northing, depth=1):
     easting = base_round(easting, 50)
     northing = base_round(northing, 50)
 
-    # Open the raster file
-    raster_file = rasterio.open(paths.CCAR_FILE)
+    cells = read_ccar_square(easting, northing, depth,
+                             raster_file=_get_ccar())
+
+    # Order by largest CCAR, then closest. lexsort is stable so remaining
+    # ties keep the order the cells were read in.
+    best_idx = np.lexsort((cells["distance"], -cells["ccar"]))[0]
+    best_cell = _cell_dict(cells, best_idx)
+
+    return best_cell
+
 
-    best_cell = None
+def _nearest_above(arr, centre_row, centre_col, min_ccar, null_value):
+    """
+    Find the cell in arr closest to the centre cell that has a value of at
+    least min_ccar (ignoring null_value). If more than one is at the same
+    distance, the one with the largest value is taken.
 
-    cell_dicts = read_ccar_square(easting, northing, depth,
-                                  raster_file=raster_file)
+    Squares of growing size around the centre are checked, stopping once no
+    cell in the next square could be closer than the best found.
 
-    for cell_dict in cell_dicts:
-        if best_cell is None:
-            best_cell = cell_dict
+    Returns the (row, col) of the cell, or (-1, -1) if none found.
 
-        elif cell_dict["ccar"] >= best_cell["ccar"]:
-            # If equal maxes, check distance.
-            if cell_dict["ccar"] == best_cell["ccar"] and \
-                    cell_dict["distance"] >= best_cell["distance"]:
-                # Is no closer so do not replace.
+    """
+    n_rows, n_cols = arr.shape
+    max_depth = max(centre_row, centre_col, n_rows - 1 - centre_row,
+                    n_cols - 1 - centre_col)
+
+    best_row = -1
+    best_col = -1
+    best_dist2 = -1
+    best_val = 0
+    for depth in range(max_depth + 1):
+        if best_dist2 >= 0 and depth * depth > best_dist2:
+            break
+
+        for row in range(centre_row - depth, centre_row + depth + 1):
+            if row < 0 or row >= n_rows:
                 continue
 
-            best_cell = cell_dict
+            # Top and bottom rows of the square are checked in full, the
+            # rows between only have their two side cells checked.
+            if row == centre_row - depth or row == centre_row + depth:
+                step = 1
+            else:
+                step = 2 * depth
+
+            col = centre_col - depth
+            while col <= centre_col + depth:
+                if 0 <= col < n_cols:
+                    val = arr[row, col]
+                    if val != null_value and val >= min_ccar:
+                        dist2 = (row - centre_row)**2 + (col - centre_col)**2
+                        if best_dist2 < 0 or dist2 < best_dist2 or \
+                                (dist2 == best_dist2 and val > best_val):
+                            best_row = row
+                            best_col = col
+                            best_dist2 = dist2
+                            best_val = val
+                col += step
+
+    return best_row, best_col
+
+
+def _nearest_above_mask(arr, centre_row, centre_col, min_ccar, null_value):
+    """
+    Vectorised version of _nearest_above. The window is reduced to a boolean
+    mask of the cells passing the threshold and the nearest of those is picked
+    in one go, with ties broken in the same order as _nearest_above.
 
-    raster_file.close()
+    """
+    rows, cols = np.nonzero((arr >= min_ccar) & (arr != null_value))
+    if rows.size == 0:
+        return -1, -1
 
-    return best_cell
+    # Keep only the nearest cells, any ties between them are broken on the
+    # largest value and then the order the squares are searched in
+    # (np.nonzero already gives the cells row by row).
+    dist2 = (rows - centre_row)**2 + (cols - centre_col)**2
+    nearest = dist2 == dist2.min()
+    rows = rows[nearest]
+    cols = cols[nearest]
+    square = np.maximum(np.abs(rows - centre_row), np.abs(cols - centre_col))
+    best = np.lexsort((square, -arr[rows, cols].astype(np.int64)))[0]
+
+    return int(rows[best]), int(cols[best])
+
+
+if njit is not None:
+    _nearest_above = njit(cache=True)(_nearest_above)
+else:
+    # Without numba the search loop runs slowly as plain Python, so use the
+    # vectorised version instead.
+    _nearest_above = _nearest_above_mask
 
 
 def closest_ccar_above_val(easting, northing, min_ccar=10, max_depths=20):
@@ -764,57 +1415,19 @@ def closest_ccar_above_val(easting, northing, min_ccar=10, max_depths=20):
     Find the cell nearest to a given cell that has at least the given CCAR
     value.
 
+    The whole square, out to max_depths cells either side, is read in one go
+    and searched for the nearest passing cell. If more than one passing cell
+    is at the same distance, the one with the largest CCAR is returned.
+
     """
     # Round easting and northing to the closest 50m
     easting = base_round(easting, 50)
     northing = base_round(northing, 50)
 
-    # Open the raster file
-    raster_file = rasterio.open(paths.CCAR_FILE)
-
-    best_cell = None
-    extra_depths = None
-    for depth in range(0, max_depths + 1):
-        if extra_depths is not None:
-            if extra_depths == 0:
-                break
-            else:
-                extra_depths -= 1
-
-        # Gather cell data for growing squares around the centre.
-        cell_dicts = read_ccar_square(easting, northing, depth,
-                                      border_only=True,
-                                      raster_file=raster_file)
-
-        for cell_dict in cell_dicts:
-            if cell_dict["ccar"] >= min_ccar:
-                # We found a cell that passes the min ccar test, but there
-                # could be others in the square and we want the closest.
-                if best_cell is None:
-                    best_cell = cell_dict
-
-                elif cell_dict["distance"] <= best_cell["distance"]:
-                    if cell_dict["distance"] == best_cell["distance"]:
-                        # If equal distance, check CCAR
-                        if cell_dict["ccar"] <= best_cell["ccar"]:
-                            # CCAR no larger so do not replace.
-                            continue
-
-                    best_cell = cell_dict
-
-                # Our search expands by square size. This means as the square
-                # gets bigger, there is a chance that the corners of an inner
-                # square and further away than the sides of the next outer
-                # square.
-                # This means, once the depth is a certain size, we need to keep
-                # checking further depths to make sure we actually have the
-                # closest. How many extra depths to check depends on the
-                # current depth and has been worked out and stored in
-                # DEPTH_CHECK_MAP.
-                extra_depths = DEPTH_CHECK_MAP[depth]
-
-    raster_file.close()
+    arr = _read_ccar_window(easting, northing, max_depths, _get_ccar())
 
+    best_cell = closest_ccar_above_val_array(arr, easting, northing,
+                                             min_ccar=min_ccar)
     if best_cell is None:
         print("No cell found with CCAR > %s in surrounding area. %s depths "
               "search" % (min_ccar, max_depths))
@@ -822,16 +1435,171 @@ def closest_ccar_above_val(easting, northing, min_ccar=10, max_depths=20):
     return best_cell
 
 
-def getFeatures(gdf):
+def closest_ccar_above_val_array(arr, easting, northing, min_ccar=10):
+    """
+    As closest_ccar_above_val, but searching a CCAR window that has already
+    been read (see _read_ccar_window). The window must be centred on the given
+    easting and northing (rounded to 50m).
+
+    Returns None if no cell is found.
+
+    """
+    depth = arr.shape[0] // 2
+
+    row, col = _nearest_above(arr, depth, depth, min_ccar, CCAR_NULL_VALUE)
+    if row < 0:
+        return None
+
+    # Row 0 of the window is the northern edge, column 0 the western edge.
+    e_offset = 50 * (col - depth)
+    n_offset = 50 * (depth - row)
+
+    return {
+        "easting": easting + e_offset,
+        "northing": northing + n_offset,
+        "ccar": int(arr[row, col]),
+        "distance": sqrt(e_offset**2 + n_offset**2),
+    }
+
+
+@functools.lru_cache(maxsize=16)
+def _river_kdtree(tile_e, tile_n, min_ccar, margin):
+    """
+    Build a KD-tree of the CCAR cells with a value of at least min_ccar in one
+    RIVER_TILE_SIZE square tile of the raster, plus margin cells either side.
+    Cached, so each tile is only read and built once.
+
+    Returns the tree and the easting, northing and CCAR of each cell in it, or
+    None if the tile has no such cells.
+
+    """
+    from scipy.spatial import cKDTree
+
+    # Read the tile as one window centred on its middle cell.
+    half = RIVER_TILE_SIZE // 2
+    centre_e = (tile_e * RIVER_TILE_SIZE) + half
+    centre_n = (tile_n * RIVER_TILE_SIZE) + half
+    depth = (half // 50) + margin
+    arr = _read_ccar_window(centre_e, centre_n, depth, _get_ccar())
+
+    rows, cols = np.nonzero((arr >= min_ccar) & (arr != CCAR_NULL_VALUE))
+    if rows.size == 0:
+        return None
+
+    eastings = centre_e + (50 * (cols - depth))
+    northings = centre_n + (50 * (depth - rows))
+    tree = cKDTree(np.column_stack((eastings, northings)))
+
+    return tree, eastings, northings, arr[rows, cols]
+
+
+def _snap_with_kdtree(eastings, northings, min_ccar, max_depths):
+    """
+    Snap (rounded) coordinates to the river using the _river_kdtree of the
+    tile each falls in.
+
+    Returns the snapped eastings and northings, and a mask of which were
+    snapped. The rest are left for the window search: those with no cell
+    close enough, with the nearest cell outside the max_depths square, or
+    with a tie the tree can't settle.
+
     """
-    Function to parse features from GeoDataFrame in such a manner that rasterio
-    wants them.
+    snapped_eastings = eastings.copy()
+    snapped_northings = northings.copy()
+    snapped = np.zeros(len(eastings), dtype=bool)
+
+    reach = 50 * max_depths
+    tiles_e = eastings // RIVER_TILE_SIZE
+    tiles_n = northings // RIVER_TILE_SIZE
+    for tile_e, tile_n in np.unique(np.column_stack((tiles_e, tiles_n)),
+                                    axis=0).tolist():
+        tile = _river_kdtree(tile_e, tile_n, min_ccar, max_depths)
+        if tile is None:
+            continue
+
+        tree, cell_eastings, cell_northings, cell_ccars = tile
+        idxs = np.flatnonzero((tiles_e == tile_e) & (tiles_n == tile_n))
+
+        # Take a few neighbours so that ties on distance can be broken on
+        # the largest CCAR, as the window search does.
+        k = min(8, len(cell_ccars))
+        dists, cells = tree.query(
+            np.column_stack((eastings[idxs], northings[idxs])), k=k)
+        dists = dists.reshape(len(idxs), k)
+        cells = cells.reshape(len(idxs), k)
+
+        for i, point_dists, point_cells in zip(idxs.tolist(), dists, cells):
+            tied = point_cells[point_dists == point_dists[0]]
+            if len(tied) == k and k < len(cell_ccars):
+                continue
+
+            best = tied[cell_ccars[tied] == cell_ccars[tied].max()]
+            if len(best) > 1:
+                continue
+
+            best = best[0]
+            if abs(cell_eastings[best] - eastings[i]) > reach or \
+                    abs(cell_northings[best] - northings[i]) > reach:
+                continue
+
+            snapped_eastings[i] = cell_eastings[best]
+            snapped_northings[i] = cell_northings[best]
+            snapped[i] = True
 
+    return snapped_eastings, snapped_northings, snapped
+
+
+def snap_coords_to_river(eastings, northings, min_ccar=200, max_depths=20,
+                         raise_on_missing=True):
     """
-    return [json.loads(gdf.to_json())['features'][0]['geometry']]
+    Shift each set of coordinates to the closest cell on a river, i.e. with a
+    CCAR of at least min_ccar. This is the many coordinate version of the
+    snap_to_river option of CatchmentData.
+
+    Coordinates are snapped with a KD-tree of the river cells where scipy is
+    available, falling back to searching the CCAR window around each one.
+
+    Coordinates with no river cell close enough raise a UserWarning, or if
+    raise_on_missing is False are left (rounded to 50m) unsnapped.
 
+    Returns arrays of the snapped eastings and northings, and a mask of which
+    were snapped.
 
-def crop_grid(easting, northing, depth):
+    """
+    # Round easting and northing to the closest 50m
+    eastings = _base_round_arr(eastings, 50)
+    northings = _base_round_arr(northings, 50)
+
+    try:
+        snapped_eastings, snapped_northings, snapped = _snap_with_kdtree(
+            eastings, northings, min_ccar, max_depths)
+    except ImportError:
+        # scipy is optional, without it every coordinate is window searched.
+        snapped_eastings = eastings.copy()
+        snapped_northings = northings.copy()
+        snapped = np.zeros(len(eastings), dtype=bool)
+
+    raster_file = _get_ccar()
+    for i in np.flatnonzero(~snapped).tolist():
+        easting = int(eastings[i])
+        northing = int(northings[i])
+        arr = _read_ccar_window(easting, northing, max_depths, raster_file)
+        cell_dict = closest_ccar_above_val_array(arr, easting, northing,
+                                                 min_ccar=min_ccar)
+        if cell_dict is None:
+            if raise_on_missing:
+                raise UserWarning("No cell found close enough for river "
+                                  "snapping at (%s, %s)" % (easting, northing))
+            continue
+
+        snapped_eastings[i] = cell_dict["easting"]
+        snapped_northings[i] = cell_dict["northing"]
+        snapped[i] = True
+
+    return snapped_eastings, snapped_northings, snapped
+
+
+def crop_grid(easting, northing, depth, in_memory=False):
     """
     This function creates a clipped version of CCAR file, since CCAR file is
     large and kernel crashes (low memory).
@@ -839,46 +1607,87 @@ def crop_grid(easting, northing, depth):
     Use this to get the cropped version of CCAR below, for plotting
     input is easting, northing of centre cell, and depth: number of cells
     either side.
+    With in_memory, the clipped raster is instead kept in a rasterio
+    MemoryFile, which is returned (pass it on to plot_grid_and_values, which
+    closes it).
 
     """
-    raster_file = rasterio.open(paths.CCAR_FILE)
+    raster_file = _get_ccar()
     radius = depth * 50
-    bbox = box(easting - radius, northing - radius,
-               easting + radius, northing + radius)
-    geo  = gpd.GeoDataFrame({'geometry': bbox}, index=[0],
-                            crs=from_epsg(27700))
-    geo = geo.to_crs(crs=raster_file.crs.data)
-    coords = getFeatures(geo)
-    out_img, out_transform = mask(dataset=raster_file, shapes=coords,
-                                  crop=True)
+    window = from_bounds(easting - radius, northing - radius,
+                         easting + radius, northing + radius,
+                         transform=raster_file.transform)
+    # Keep every cell the square touches, flooring the near edges and
+    # ceiling the far ones, so centres off the 50m grid still get the east
+    # column and south row.
+    col_off = int(np.floor(window.col_off))
+    row_off = int(np.floor(window.row_off))
+    window = Window(col_off, row_off,
+                    int(np.ceil(window.col_off + window.width)) - col_off,
+                    int(np.ceil(window.row_off + window.height)) - row_off)
+    out_img = raster_file.read(window=window)
+    out_transform = raster_file.window_transform(window)
     out_meta = raster_file.meta.copy()
-    epsg_code = int(raster_file.crs.data['init'][5:])
     out_meta.update({"driver": "GTiff",
                      "height": out_img.shape[1],
                      "width": out_img.shape[2],
                      "transform": out_transform,
                      "crs": 27700})
+    if in_memory:
+        memfile = MemoryFile()
+        with memfile.open(**out_meta) as dest:
+            dest.write(out_img)
+
+        return memfile
+
     with rasterio.open(paths.TEMP_CCAR_FILE, "w", **out_meta) as dest:
         dest.write(out_img)
 
 
-def plot_grid_and_values(pts):
+def plot_grid_and_values(pts, memfile=None, max_labels=2500):
+    # Plotting libraries are only needed here, so import them on use rather
+    # than when the module loads.
+    import numpy.ma as ma
+    import matplotlib.pyplot as plt
+    from matplotlib.colors import LogNorm
+    from rasterio.plot import show
+
     # Usually 3 points, colour them red, orange and blue
     cols = ['red', 'orange', 'blue']
-    raster_file = rasterio.open(paths.TEMP_CCAR_FILE)
-    left = raster_file.bounds[0] + 25
-    top = raster_file.bounds[3] - 25
+
+    # Plot the in memory raster from crop_grid if given, otherwise its file.
+    # The MemoryFile is closed along with its dataset once read.
+    if memfile is not None:
+        raster_file = memfile.open()
+    else:
+        memfile = contextlib.nullcontext()
+        raster_file = rasterio.open(paths.TEMP_CCAR_FILE)
+
+    # Read the band once and use it for both the plot and the labels.
+    with memfile, raster_file:
+        band = raster_file.read(1, masked=True)
+        transform = raster_file.transform
+        left = raster_file.bounds[0] + 25
+        top = raster_file.bounds[3] - 25
+
     fig, ax = plt.subplots(figsize=(20, 20))
-    show(raster_file, ax=ax, cmap="Greens", norm=LogNorm())
-    arr = raster_file.read(1)
-    arr_masked = ma.array(arr)
-    null_val = 2147483647
-    arr_masked[arr == null_val] = ma.masked
-
-    for (j, i), label in np.ndenumerate(arr_masked):
-        if label != null_val:
-            ax.text((left + (i * 50)), (top - (j * 50)), label, ha='center',
-                    va='center')
+    show(band, transform=transform, ax=ax, cmap="Greens", norm=LogNorm())
+    arr = band.data
+    arr_masked = ma.masked_equal(arr, CCAR_NULL_VALUE, copy=False)
+
+    # Label only the unmasked cells, with their positions worked out in one go.
+    cell_rows, cell_cols = np.nonzero(~ma.getmaskarray(arr_masked))
+    xs = left + (cell_cols * 50)
+    ys = top - (cell_rows * 50)
+
+    # Each label is its own artist to draw, so skip them on grids too large
+    # for the values to be read anyway.
+    if len(xs) > max_labels:
+        print("%s cells is more than max_labels (%s), values not plotted"
+              % (len(xs), max_labels))
+    else:
+        for x, y, label in zip(xs, ys, arr[cell_rows, cell_cols]):
+            ax.text(x, y, label, ha='center', va='center')
 
     for i in range(len(pts)):
         plt.scatter(pts[i][0], pts[i][1], s=300, c=cols[i], marker='o')
@@ -3,6 +3,12 @@
 # Set standard date format to ISO 8601
 DATE_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
 
+# How long (seconds) API responses are cached on disk before being re-fetched.
+# 0 (the default) turns the cache off. Only turn it on to rerun a pull
+# quickly, e.g. when debugging, as paged pulls (such as the EA_WQ
+# measurements) can mix cached pages with new ones if the data has changed.
+API_CACHE_MAX_AGE = 0
+
 # Network IDs
 EA_WQ_ID = "EA_WQ"
 EA_INV_ID = "EA_INV"
@@ -16,5 +22,7 @@ NRFA_ID = "NRFA"
 
 EA_BIO_ID = "EA_BIO"
 
-VALID_NETWORKS = [EA_WQ_ID, EA_INV_ID, EA_MACP_ID, EA_DIAT_ID, EA_FISH_ID,
-                  RF_ID, SMTR_ID, FWW_ID, NRFA_ID]
+# Ordered for running "all" networks, with a set for checking network IDs
+VALID_NETWORKS = (EA_WQ_ID, EA_INV_ID, EA_MACP_ID, EA_DIAT_ID, EA_FISH_ID,
+                  RF_ID, SMTR_ID, FWW_ID, NRFA_ID)
+VALID_NETWORK_SET = frozenset(VALID_NETWORKS)
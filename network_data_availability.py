@@ -45,17 +45,32 @@ import paths
 import config
 import utils
 
+import urllib.parse
 import urllib.request
 import os
+import gzip
+import hashlib
 import json
+import time
+import tempfile
+import threading
 import pandas as pd
 import numpy as np
 import geopandas as gpd
 
 from geopandas.tools import sjoin
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pyproj import Transformer
 
+try:
+    import requests
+except ImportError:
+    # requests is optional, without it each API call opens a new connection.
+    requests = None
+
+_HTTP_LOCAL = threading.local()
+
 
 def make_network_dict(network_id=None, network_name=None, network_desc=None,
                       folder=None, shape=None, access=None, updates=None,
@@ -184,12 +199,77 @@ def _str_to_date(date_string, date_format, default_now=False):
     return dt
 
 
+def _get_session():
+    """
+    Return the requests session for this thread, so that API calls made from
+    the same thread reuse their connection rather than each opening a new one.
+
+    """
+    session = getattr(_HTTP_LOCAL, "session", None)
+    if session is None:
+        session = requests.Session()
+        _HTTP_LOCAL.session = session
+
+    return session
+
+
+def _get_json(url):
+    """
+    Fetch and decode a JSON API response. If config.API_CACHE_MAX_AGE is set,
+    responses are cached on disk by URL, so calls repeated within that many
+    seconds are read from the cache rather than made again. A cache file that
+    can't be read (e.g. left damaged by an earlier run) is treated as missing.
+
+    """
+    use_cache = config.API_CACHE_MAX_AGE > 0
+    cache_fpath = "%s%s.json.gz" % (
+        paths.API_CACHE_DIR, hashlib.md5(url.encode("utf-8")).hexdigest())
+    cache_fresh = use_cache and os.path.exists(cache_fpath) and (
+        time.time() - os.path.getmtime(cache_fpath)
+        < config.API_CACHE_MAX_AGE)
+    if cache_fresh:
+        try:
+            with gzip.open(cache_fpath, "rt") as cache_file:
+                return json.load(cache_file)
+        except (OSError, EOFError, ValueError):
+            print("Unreadable API cache file %s, fetching again"
+                  % cache_fpath)
+
+    if requests is not None:
+        response = _get_session().get(url)
+        response.raise_for_status()
+        data = response.json()
+    else:
+        with urllib.request.urlopen(url) as response:
+            data = json.load(response)
+
+    if not use_cache:
+        return data
+
+    # Write to a temporary file then move it into place, so an interrupted
+    # write never leaves a partial cache file behind.
+    os.makedirs(paths.API_CACHE_DIR, exist_ok=True)
+    fd, temp_fpath = tempfile.mkstemp(suffix=".tmp", dir=paths.API_CACHE_DIR)
+    try:
+        with os.fdopen(fd, "wb") as raw_file, \
+                gzip.open(raw_file, "wt") as cache_file:
+            json.dump(data, cache_file)
+        os.replace(temp_fpath, cache_fpath)
+    except BaseException:
+        os.remove(temp_fpath)
+        raise
+
+    return data
+
+
 # *** EA water quality ********************************************************
 """
 Data for nitrate and phosphate EA water quality (EA_WQ) samples from API.
 
 """
 EA_WQ_API_DATE_FORMAT = "%Y-%m-%dT%H:%M:%S"
+# Number of measurement pages requested from the API at once
+EA_WQ_PAGE_WORKERS = 8
 EA_WQ_DTYE_IDS = [
     "0117",
     "0180"
@@ -202,6 +282,52 @@ EA_WQ_MATERIALS = [
 ]
 
 
+def _EA_WQ_measurement_pages(limit=500, limit_calls=None):
+    """
+    Yield pages of EA_WQ measurements from the API, in order.
+    Pages are requested EA_WQ_PAGE_WORKERS at a time, in parallel, until a page
+    has less than limit items (the end of the measurements) or limit_calls
+    pages have been returned.
+
+    """
+    # Filter part of the query string, the same for every page
+    filters = urllib.parse.urlencode(
+        [("determinand", det_id) for det_id in EA_WQ_DTYE_IDS] +
+        [("sampledMaterialType", material) for material in EA_WQ_MATERIALS],
+        safe="/:")
+
+    def get_page(offset):
+        query = urllib.parse.urlencode({"_limit": limit, "_offset": offset})
+
+        # Full URL
+        url = "%s/data/measurement?%s&%s" % (paths.EA_WQ_API_URL, query,
+                                             filters)
+
+        return _get_json(url)
+
+    offset = 0
+    calls = 0
+    with ThreadPoolExecutor(max_workers=EA_WQ_PAGE_WORKERS) as pool:
+        while True:
+            n_pages = EA_WQ_PAGE_WORKERS
+            if limit_calls is not None:
+                n_pages = max(1, min(n_pages, limit_calls - calls))
+
+            offsets = [offset + (i * limit) for i in range(n_pages)]
+            for page_offset, data in zip(offsets, pool.map(get_page, offsets)):
+                print("Measurement call %s to %s" % (page_offset,
+                                                     page_offset + limit))
+                calls += 1
+                yield data
+
+                # Check if response has less than limit, indicating the end of
+                # available sites.
+                if len(data["items"]) < limit or calls == limit_calls:
+                    return
+
+            offset += n_pages * limit
+
+
 def create_EA_WQ_metadata(limit_calls=None):
     """
     Create metatdata on the sites, data types and data availability for EA
@@ -215,97 +341,69 @@ def create_EA_WQ_metadata(limit_calls=None):
     # Set up coordinate transformation
     transformer = Transformer.from_crs("EPSG:27700", "EPSG:4326")
 
-    limit = 500
-    offset = 0
-
     dtype_rows = {}
     sites_rows = {}
     avail_rows = {}
     measure_values = {}
 
-    finished = False
-    calls = 0
-    while finished is False:
-        # Query string
-        materials = "&sampledMaterialType=".join(EA_WQ_MATERIALS)
-        det_ids = "&determinand=".join(EA_WQ_DTYE_IDS)
-        query = "_limit=%s&_offset=%s&determinand=%s&sampledMaterialType=%s" \
-                % (limit, offset, det_ids, materials)
-
-        # Full URL
-        url = "%s/data/measurement?%s" % (paths.EA_WQ_API_URL, query)
-
-        with urllib.request.urlopen(url) as response:
-            print("Measurement call %s to %s" % (offset, offset + limit))
-            calls += 1
-            data = json.load(response)
-
-            # Check if response has less than limit, indicating the end of
-            # available sites.
-            if len(data["items"]) < limit:
-                finished = True
-
-            if limit_calls is not None and limit_calls == calls:
-                finished = True
-
-            for measure_info in data["items"]:
-                # Site data
-                site_info = measure_info["sample"]["samplingPoint"]
-                site_id = site_info["notation"]
-                if site_id not in sites_rows:
-                    lat, long = transformer.transform(site_info["easting"],
-                                                      site_info["northing"])
-                    site_dict = make_site_dict(site_id=site_id,
-                                               site_name=site_info["label"],
-                                               network_id=config.EA_WQ_ID,
-                                               lat=lat,
-                                               long=long)
-                    sites_rows[site_id] = site_dict
-
-                # Data type data
-                dtype_info = measure_info["determinand"]
-                dtype_id = dtype_info["notation"]
-                if dtype_id not in dtype_rows:
-                    dtype_dict = make_dtype_dict(
-                        dtype_id=dtype_id,
-                        dtype_name=dtype_info["label"],
-                        network_id=config.EA_WQ_ID,
-                        dtype_desc=dtype_info["definition"],
-                        units=dtype_info["unit"]["label"])
-                    dtype_rows[dtype_id] = dtype_dict
-
-                # Availability stats
-                sample_date = datetime.strptime(
-                    measure_info["sample"]["sampleDateTime"],
-                    EA_WQ_API_DATE_FORMAT)
-
-                # Set up dictionaries for measurements and availability
-                if site_id not in measure_values:
-                    measure_values[site_id] = {}
-                    avail_rows[site_id] = {}
-                if dtype_id not in measure_values[site_id]:
-                    measure_values[site_id][dtype_id] = []
-                    avail_rows[site_id][dtype_id] = None
-
-                # Collect the actual data
-                measure_values[site_id][dtype_id].append(
-                    measure_info["result"])
-
-                if avail_rows[site_id][dtype_id] is None:
-                    avail_dict = make_avail_dict(site_id=site_id,
-                                                 network_id=config.EA_WQ_ID,
-                                                 dtype_id=dtype_id,
-                                                 start_date=sample_date,
-                                                 end_date=sample_date)
-                    avail_rows[site_id][dtype_id] = avail_dict
-
-                else:
-                    if sample_date < avail_rows[site_id][dtype_id]["START_DATE"]:
-                        avail_rows[site_id][dtype_id]["START_DATE"] = sample_date
-                    elif sample_date > avail_rows[site_id][dtype_id]["END_DATE"]:
-                        avail_rows[site_id][dtype_id]["END_DATE"] = sample_date
+    for data in _EA_WQ_measurement_pages(limit_calls=limit_calls):
+        # Parse the sample dates for the whole page in one go
+        sample_dates = pd.to_datetime(
+            [measure_info["sample"]["sampleDateTime"]
+             for measure_info in data["items"]],
+            format=EA_WQ_API_DATE_FORMAT).to_pydatetime()
+
+        for measure_info, sample_date in zip(data["items"], sample_dates):
+            # Site data
+            site_info = measure_info["sample"]["samplingPoint"]
+            site_id = site_info["notation"]
+            if site_id not in sites_rows:
+                lat, long = transformer.transform(site_info["easting"],
+                                                  site_info["northing"])
+                site_dict = make_site_dict(site_id=site_id,
+                                           site_name=site_info["label"],
+                                           network_id=config.EA_WQ_ID,
+                                           lat=lat,
+                                           long=long)
+                sites_rows[site_id] = site_dict
+
+            # Data type data
+            dtype_info = measure_info["determinand"]
+            dtype_id = dtype_info["notation"]
+            if dtype_id not in dtype_rows:
+                dtype_dict = make_dtype_dict(
+                    dtype_id=dtype_id,
+                    dtype_name=dtype_info["label"],
+                    network_id=config.EA_WQ_ID,
+                    dtype_desc=dtype_info["definition"],
+                    units=dtype_info["unit"]["label"])
+                dtype_rows[dtype_id] = dtype_dict
+
+            # Set up dictionaries for measurements and availability
+            if site_id not in measure_values:
+                measure_values[site_id] = {}
+                avail_rows[site_id] = {}
+            if dtype_id not in measure_values[site_id]:
+                measure_values[site_id][dtype_id] = []
+                avail_rows[site_id][dtype_id] = None
+
+            # Collect the actual data
+            measure_values[site_id][dtype_id].append(
+                measure_info["result"])
+
+            if avail_rows[site_id][dtype_id] is None:
+                avail_dict = make_avail_dict(site_id=site_id,
+                                             network_id=config.EA_WQ_ID,
+                                             dtype_id=dtype_id,
+                                             start_date=sample_date,
+                                             end_date=sample_date)
+                avail_rows[site_id][dtype_id] = avail_dict
 
-        offset += limit
+            else:
+                if sample_date < avail_rows[site_id][dtype_id]["START_DATE"]:
+                    avail_rows[site_id][dtype_id]["START_DATE"] = sample_date
+                elif sample_date > avail_rows[site_id][dtype_id]["END_DATE"]:
+                    avail_rows[site_id][dtype_id]["END_DATE"] = sample_date
 
     # Go through measurements and work out stats
     for site_id, site_dict in measure_values.items():
@@ -1403,59 +1501,58 @@ def create_NRFA_metadata():
     # Full URL
     url = "%s/station-info?%s" % (paths.NRFA_API_URL, query)
 
-    with urllib.request.urlopen(url) as response:
-        data = json.load(response)
-        for site_info in data["data"]:
-            site = make_site_dict(site_id=site_info["id"],
-                                  site_name=site_info["name"],
-                                  network_id=config.NRFA_ID,
-                                  lat=site_info["lat-long"]["latitude"],
-                                  long=site_info["lat-long"]["longitude"])
-
-            sites_rows.append(site)
-            site_ids.append(site_info["id"])
-
-            # Sort dates
-            gdf_start_date = _str_to_date(site_info["gdf-start-date"],
-                                          NRFA_DATE_FORMAT)
-            gdf_end_date = _str_to_date(site_info["gdf-end-date"],
-                                        NRFA_DATE_FORMAT, default_now=True)
-            pot_start_date = _str_to_date(site_info["peak-flow-start-date"],
-                                          NRFA_DATE_FORMAT)
-            pot_end_date = _str_to_date(site_info["peak-flow-end-date"],
-                                        NRFA_DATE_FORMAT, default_now=True)
-
-            if gdf_start_date is not None:
-                # GDF availability
-                gdf_avail_dict = make_avail_dict(
-                    site_id=site_info["id"],
-                    network_id=config.NRFA_ID,
-                    dtype_id="gdf",
-                    start_date=gdf_start_date,
-                    end_date=gdf_end_date,
-                    value_count=site_info["gdf-flow-count"],
-                    value_mean=site_info["gdf-mean-flow"])
-                avail_rows.append(gdf_avail_dict)
-
-                # CDF availability (mean and count not available, will add later
-                # from file)
-                cdr_avail_dict = make_avail_dict(
-                    site_id=site_info["id"],
-                    network_id=config.NRFA_ID,
-                    dtype_id="cdr",
-                    start_date=gdf_start_date,
-                    end_date=gdf_end_date)
-                avail_rows.append(cdr_avail_dict)
-
-            if pot_start_date is not None:
-                # Peak flow availability
-                pot_avail_dict = make_avail_dict(
-                    site_id=site_info["id"],
-                    network_id=config.NRFA_ID,
-                    dtype_id="pot-flow",
-                    start_date=pot_start_date,
-                    end_date=pot_end_date)
-                avail_rows.append(pot_avail_dict)
+    data = _get_json(url)
+    for site_info in data["data"]:
+        site = make_site_dict(site_id=site_info["id"],
+                              site_name=site_info["name"],
+                              network_id=config.NRFA_ID,
+                              lat=site_info["lat-long"]["latitude"],
+                              long=site_info["lat-long"]["longitude"])
+
+        sites_rows.append(site)
+        site_ids.append(site_info["id"])
+
+        # Sort dates
+        gdf_start_date = _str_to_date(site_info["gdf-start-date"],
+                                      NRFA_DATE_FORMAT)
+        gdf_end_date = _str_to_date(site_info["gdf-end-date"],
+                                    NRFA_DATE_FORMAT, default_now=True)
+        pot_start_date = _str_to_date(site_info["peak-flow-start-date"],
+                                      NRFA_DATE_FORMAT)
+        pot_end_date = _str_to_date(site_info["peak-flow-end-date"],
+                                    NRFA_DATE_FORMAT, default_now=True)
+
+        if gdf_start_date is not None:
+            # GDF availability
+            gdf_avail_dict = make_avail_dict(
+                site_id=site_info["id"],
+                network_id=config.NRFA_ID,
+                dtype_id="gdf",
+                start_date=gdf_start_date,
+                end_date=gdf_end_date,
+                value_count=site_info["gdf-flow-count"],
+                value_mean=site_info["gdf-mean-flow"])
+            avail_rows.append(gdf_avail_dict)
+
+            # CDF availability (mean and count not available, will add later
+            # from file)
+            cdr_avail_dict = make_avail_dict(
+                site_id=site_info["id"],
+                network_id=config.NRFA_ID,
+                dtype_id="cdr",
+                start_date=gdf_start_date,
+                end_date=gdf_end_date)
+            avail_rows.append(cdr_avail_dict)
+
+        if pot_start_date is not None:
+            # Peak flow availability
+            pot_avail_dict = make_avail_dict(
+                site_id=site_info["id"],
+                network_id=config.NRFA_ID,
+                dtype_id="pot-flow",
+                start_date=pot_start_date,
+                end_date=pot_end_date)
+            avail_rows.append(pot_avail_dict)
 
     # Add additional data from file
     cdr_mean_data = pd.read_csv(paths.NRFA_CDR_DATA_FILE)
@@ -1483,32 +1580,30 @@ def create_NRFA_metadata():
     amax_mean_data["start"] = pd.to_datetime(amax_mean_data["start"])
     amax_mean_data["end"] = pd.to_datetime(amax_mean_data["end"])
 
-    for i, row in amax_mean_data.iterrows():
-        if row["STATION"] not in site_ids:
-            continue
-
+    amax_mean_data = amax_mean_data[amax_mean_data["STATION"].isin(site_ids)]
+    for row in amax_mean_data.itertuples(index=False):
         # AMAX stage
-        if pd.notnull(row["mean_amax_stage"]):
+        if pd.notnull(row.mean_amax_stage):
             amst_avail_dict = make_avail_dict(
-                site_id=row["STATION"],
+                site_id=row.STATION,
                 network_id=config.NRFA_ID,
                 dtype_id="amax-stage",
-                start_date=row["start"],
-                end_date=row["end"],
-                value_count=row["count_stage"],
-                value_mean=row["mean_amax_stage"])
+                start_date=row.start,
+                end_date=row.end,
+                value_count=row.count_stage,
+                value_mean=row.mean_amax_stage)
             checked_avail_rows.append(amst_avail_dict)
 
         # AMAX flow
-        if pd.notnull(row["mean_amax_flow"]):
+        if pd.notnull(row.mean_amax_flow):
             amfl_avail_dict = make_avail_dict(
-                site_id=row["STATION"],
+                site_id=row.STATION,
                 network_id=config.NRFA_ID,
                 dtype_id="amax-flow",
-                start_date=row["start"],
-                end_date=row["end"],
-                value_count=row["count_flow"],
-                value_mean=row["mean_amax_flow"])
+                start_date=row.start,
+                end_date=row.end,
+                value_count=row.count_flow,
+                value_mean=row.mean_amax_flow)
             checked_avail_rows.append(amfl_avail_dict)
 
     dtype_rows = _add_dtype_stats(checked_avail_rows, dtype_rows)
@@ -1563,10 +1658,15 @@ def _get_dtype_dicts(network_id):
         dtype={"DTYPE_ID": str, "SITE_ID": str})
     avail_info = avail_info.replace({np.nan: None})
 
+    # Split the availability by data type once, rather than filtering the
+    # whole table for each data type.
+    dtype_avails = dict(tuple(avail_info.groupby("DTYPE_ID", sort=False)))
+    no_avail = avail_info.iloc[:0]
+
     dtype_dicts = []
-    for i, dtype in dtypes_info.iterrows():
-        dtype_counts = avail_info[
-            avail_info["DTYPE_ID"] == dtype["DTYPE_ID"]]["SITE_VALUE_COUNT"]
+    for dtype in dtypes_info.itertuples(index=False):
+        dtype_avail = dtype_avails.get(dtype.DTYPE_ID, no_avail)
+        dtype_counts = dtype_avail["SITE_VALUE_COUNT"]
         vld_dtype_counts = dtype_counts[dtype_counts.notnull()]
 
         if len(vld_dtype_counts) > 0:
@@ -1587,31 +1687,26 @@ def _get_dtype_dicts(network_id):
                 "p_80": None,
             }
 
-        start_dates = avail_info[
-            avail_info["DTYPE_ID"] == dtype["DTYPE_ID"]]["START_DATE"]
-        start_date = pd.to_datetime(start_dates).min()
-
-        end_dates = avail_info[
-            avail_info["DTYPE_ID"] == dtype["DTYPE_ID"]]["END_DATE"]
-        end_date = pd.to_datetime(end_dates).max()
+        start_date = pd.to_datetime(dtype_avail["START_DATE"]).min()
+        end_date = pd.to_datetime(dtype_avail["END_DATE"]).max()
 
         dtype_dict = {
-            "dtype_id": dtype["DTYPE_ID"],
-            "dtype_name": dtype["DTYPE_NAME"],
-            "dtype_desc": dtype["DTYPE_DESC"],
-            "network_id": dtype["NETWORK_ID"],
-            "mean_min": _try_round(dtype["MEAN_MIN"], 2),
+            "dtype_id": dtype.DTYPE_ID,
+            "dtype_name": dtype.DTYPE_NAME,
+            "dtype_desc": dtype.DTYPE_DESC,
+            "network_id": dtype.NETWORK_ID,
+            "mean_min": _try_round(dtype.MEAN_MIN, 2),
             "count_min": count_min,
             "count_percentiles": count_percentiles,
             "value_percentiles": {
-                "p_20": _try_round(dtype["MEAN_PERCENTILE_20"], 2),
-                "p_40": _try_round(dtype["MEAN_PERCENTILE_40"], 2),
-                "p_60": _try_round(dtype["MEAN_PERCENTILE_60"], 2),
-                "p_80": _try_round(dtype["MEAN_PERCENTILE_80"], 2),
+                "p_20": _try_round(dtype.MEAN_PERCENTILE_20, 2),
+                "p_40": _try_round(dtype.MEAN_PERCENTILE_40, 2),
+                "p_60": _try_round(dtype.MEAN_PERCENTILE_60, 2),
+                "p_80": _try_round(dtype.MEAN_PERCENTILE_80, 2),
             },
-            "mean_max": _try_round(dtype["MEAN_MAX"], 2),
+            "mean_max": _try_round(dtype.MEAN_MAX, 2),
             "count_max": count_max,
-            "mean_mean": _try_round(dtype["MEAN_MEAN"], 2),
+            "mean_mean": _try_round(dtype.MEAN_MEAN, 2),
             "count_mean": count_mean,
             "site_count": len(dtype_counts),
             "start_date": start_date.strftime(config.DATE_FORMAT),
@@ -1817,18 +1912,18 @@ def _alt_coord_change():
     alt_coord_sites = no_area_sites[
         no_area_sites["ALT_COORDS"].notnull()]
     if len(alt_coord_sites) > 0:
-        for i, row in alt_coord_sites.iterrows():
-            for alt_coords in row["ALT_COORDS"].split(";"):
+        for row in alt_coord_sites.itertuples(index=False):
+            for alt_coords in row.ALT_COORDS.split(";"):
                 lat, lon = alt_coords.split(":")
                 # Remove brackets and make floats.
                 lat = float(lat[1:])
                 lon = float(lon[:-1])
 
                 no_area_sites.loc[
-                    no_area_sites["SITE_ID"] == row["SITE_ID"],
+                    no_area_sites["SITE_ID"] == row.SITE_ID,
                     "LATITUDE"] = lat
                 no_area_sites.loc[
-                    no_area_sites["SITE_ID"] == row["SITE_ID"],
+                    no_area_sites["SITE_ID"] == row.SITE_ID,
                     "LONGITUDE"] = lon
 
 
@@ -1871,7 +1966,7 @@ def availability_geojson_split(networks="all", split_area="op_catchments",
         networks = config.VALID_NETWORKS
     else:
         for ntwrk in networks:
-            if ntwrk not in config.VALID_NETWORKS:
+            if ntwrk not in config.VALID_NETWORK_SET:
                 raise UserWarning("%s is not a valid network. Choose from %s"
                                   % (ntwrk, ", ".join(config.VALID_NETWORKS)))
 
@@ -1963,14 +2058,15 @@ def availability_geojson_split(networks="all", split_area="op_catchments",
         # feature dictionary, so create a site reference dict.
         site_feat_dict = {}
         total_rows = len(data_avail)
-        for i, row in data_avail.iterrows():
-            print("%s avail row: %s / %s" % (network_id, i, total_rows))
-            site_id = row["SITE_ID"]
+        for row in data_avail.itertuples():
+            print("%s avail row: %s / %s" % (network_id, row.Index,
+                                              total_rows))
+            site_id = row.SITE_ID
             # Extract site and data type info, making sure there is only one
             # entry found for each.
             site = sites_groups[
                 (sites_groups["SITE_ID"] == site_id) &
-                (sites_groups["NETWORK_ID"] == row["NETWORK_ID"])]
+                (sites_groups["NETWORK_ID"] == row.NETWORK_ID)]
 
             if len(site) != 1:
                 if len(site) == 0:
@@ -1981,15 +2077,15 @@ def availability_geojson_split(networks="all", split_area="op_catchments",
             else:
                 site = site.iloc[0]
 
-            dtype = dtypes_info[(dtypes_info["DTYPE_ID"] == row["DTYPE_ID"]) &
-                                (dtypes_info["NETWORK_ID"] == row["NETWORK_ID"])]
+            dtype = dtypes_info[(dtypes_info["DTYPE_ID"] == row.DTYPE_ID) &
+                                (dtypes_info["NETWORK_ID"] == row.NETWORK_ID)]
             if len(dtype) != 1:
                 if len(dtype) == 0:
                     raise UserWarning("No data type info found for %s"
-                                      % row["DTYPE_ID"])
+                                      % row.DTYPE_ID)
                 else:
                     raise UserWarning("Multiple data type info found for %s"
-                                      % row["DTYPE_ID"])
+                                      % row.DTYPE_ID)
             else:
                 dtype = dtype.iloc[0]
 
@@ -1997,10 +2093,10 @@ def availability_geojson_split(networks="all", split_area="op_catchments",
                 "dtype_id": dtype["DTYPE_ID"],
                 "dtype_name": dtype["DTYPE_NAME"],
                 "dtype_desc": dtype["DTYPE_DESC"],
-                "start_date": row["START_DATE"].strftime(config.DATE_FORMAT),
-                "end_date": row["END_DATE"].strftime(config.DATE_FORMAT),
-                "value_count": row["SITE_VALUE_COUNT"],
-                "value_mean": row["SITE_VALUE_MEAN"],
+                "start_date": row.START_DATE.strftime(config.DATE_FORMAT),
+                "end_date": row.END_DATE.strftime(config.DATE_FORMAT),
+                "value_count": row.SITE_VALUE_COUNT,
+                "value_mean": row.SITE_VALUE_MEAN,
             }
 
             if site_id not in site_feat_dict:
@@ -2009,7 +2105,7 @@ def availability_geojson_split(networks="all", split_area="op_catchments",
                     "properties": {
                         "site_id": site_id,
                         "site_name": site["SITE_NAME"],
-                        "network_id": row["NETWORK_ID"],
+                        "network_id": row.NETWORK_ID,
                         area_key: site[area_col],
                         "dtypes": [dtype_dict],
                         "dtype_count": 1,
@@ -2062,7 +2158,7 @@ def data_types_json(networks="all"):
         networks = config.VALID_NETWORKS
     else:
         for ntwrk in networks:
-            if ntwrk not in config.VALID_NETWORKS:
+            if ntwrk not in config.VALID_NETWORK_SET:
                 raise UserWarning("%s is not a valid network. Choose from %s"
                                   % (ntwrk, ", ".join(config.VALID_NETWORKS)))
 
@@ -2089,3 +2185,5 @@ if __name__ == "__main__":
 
     #create_network_json()
     #availability_geojson_split("SMTR", split_area="ihu_areas")
+
+    pass
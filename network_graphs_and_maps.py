@@ -11,11 +11,21 @@ from network_data_availability import RF_DTYPE_DICT, \
 
 import os
 import json
+import numpy as np
 import pandas as pd
 import geopandas as gpd
 
 from geopandas.tools import sjoin
 
+# Riverflies trigger level for each record action.
+RF_TRIGGER_LEVELS = {
+    "2nd sample on or above trigger level": 1,
+    "Historic Record (no Alerts or Thresholds available)": 2,
+    "Non-polluting breach": 3,
+    "Trigger breach confirmed statutory body": 4,
+    "Trigger breach NOT confirmed statutory body": 5,
+}
+
 
 def create_RF_maps_and_graphs_data(save_live=False):
     """
@@ -57,24 +67,19 @@ def create_RF_maps_and_graphs_data(save_live=False):
             "Threshold on date": "Threshold",
         })
 
-        for i, row in rf_data.iterrows():
-            if row["Action"] == '2nd sample on or above trigger level':
-                rf_data.at[i, 'trigger_level'] = 1
-            elif row["Action"] =='Historic Record (no Alerts or Thresholds available)':
-                rf_data.at[i, 'trigger_level'] = 2
-            elif row["Action"] =='Non-polluting breach':
-                rf_data.at[i, 'trigger_level'] = 3
-            elif row["Action"] =='Trigger breach confirmed statutory body':
-                rf_data.at[i, 'trigger_level'] = 4
-            elif row["Action"] =='Trigger breach NOT confirmed statutory body':
-                rf_data.at[i, 'trigger_level'] = 5
-
-            if row["Threshold"] == "" or pd.isnull(row["Threshold"]):
-                rf_data.at[i,'threshold_marker_val'] = 0
-            elif row["Record_Score"] < row["Threshold"]:
-                rf_data.at[i,'threshold_marker_val'] = 1
-            elif row["Record_Score"] > row["Threshold"]:
-                rf_data.at[i,'threshold_marker_val'] = 2
+        # Set the trigger level and threshold marker for all records at once.
+        # Records with other actions, or a score equal to the threshold, are
+        # left as NaN.
+        rf_data["trigger_level"] = rf_data["Action"].map(
+            RF_TRIGGER_LEVELS).astype(float)
+
+        threshold = pd.to_numeric(
+            rf_data["Threshold"].where(rf_data["Threshold"] != ""))
+        rf_data["threshold_marker_val"] = np.select(
+            [threshold.isnull(),
+             rf_data["Record_Score"] < threshold,
+             rf_data["Record_Score"] > threshold],
+            [0, 1, 2], default=np.nan)
 
         rf_data["Site_full"] = rf_data["Site"] + rf_data["River"] + \
                                rf_data["Lat"].astype(str) + \
@@ -147,6 +147,10 @@ NRFA_WEBSITE = "https://nrfa.ceh.ac.uk/"
 
 
 
+# --- API cache ---------------------------------------------------------------
+API_CACHE_DIR = make_fpath(raw_dirs + ["api_cache"])
+
+
 # --- Metadata ----------------------------------------------------------------
 METADATA_CSV_DIR = make_fpath(metadata_dirs + ["csvs"])
 METADATA_AVAIL_JSON_DIR = make_fpath(metadata_dirs + ["json", "availability"])
@@ -161,6 +165,7 @@ NETWORK_INFO_FPATH = METADATA_CSV_DIR + "network_info.csv"
 DTYPE_REGISTER_FPATH = METADATA_CSV_DIR + "data_type_register_{NETWORK}.csv"
 SITE_REGISTER_FPATH = METADATA_CSV_DIR + "site_register_{NETWORK}.csv"
 DATA_AVAILABILITY_FPATH = METADATA_CSV_DIR + "data_availability_{NETWORK}.csv"
+CATCHMENT_DATA_FPATH = METADATA_CSV_DIR + "catchment_data_{NETWORK}.csv"
 
 
 # --- SAN Output --------------------------------------------------------------
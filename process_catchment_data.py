@@ -5,16 +5,68 @@ arbitory coordinates.
 
 """
 import catchment_tools as c_tools
+import config
 import paths
 
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+
+from concurrent.futures import ProcessPoolExecutor
 from pyproj import Transformer
 
 
-def network_catchment_data(networks="all", desc_types="all"):
+def _sites_catchment_data(sites):
+    """
+    Get the catchment data for a batch of sites, given as a (SITE_IDs,
+    coords, desc_types) tuple, with each descriptor tif sampled once for the
+    whole batch (see CatchmentData.batch_data). Top level so it can be run in
+    worker processes by network_catchment_data.
+
+    If reading the data fails (e.g. a tif can't be read), the sites are
+    retried one at a time so only the failing sites are reported and left
+    out.
+
+    """
+    stations, coords, desc_types = sites
+    try:
+        return c_tools.CatchmentData.batch_data(coords, desc_types=desc_types,
+                                                stations=stations,
+                                                snap_to_river=True)
+    except OSError as err:
+        print("Catchment data failed for batch of %s sites (%s), retrying "
+              "sites one at a time" % (len(stations), err))
+
+    site_data = []
+    for station, site_coords in zip(stations, coords):
+        try:
+            site_data.append(c_tools.CatchmentData.batch_data(
+                [site_coords], desc_types=desc_types, stations=[station],
+                snap_to_river=True))
+        except OSError as err:
+            print("Catchment data failed for site %s: %s" % (station, err))
+
+    if len(site_data) == 0:
+        return pd.DataFrame(columns=c_tools.DB_COLUMNS)
+
+    return pd.concat(site_data, ignore_index=True)
+
+
+def network_catchment_data(networks="all", desc_types="all", workers=None):
     """
     Get catchment data (FEH descriptors and LCM) for all sites at given
     networks and save to file.
 
+    Sites are extracted in batches (see CatchmentData.batch_data), which are
+    independent, so they are processed in parallel across the worker
+    processes (defaults to the number of CPUs). The CPUs are shared out
+    between the workers for sampling the tifs. Sites that can't be snapped to
+    a river, or whose data can't be read, are reported and left out. Sites
+    are saved in batches of nearby sites, rather than in site register
+    order. A network's file is only replaced once all its sites are done,
+    and not at all if none had any data.
+
     """
     if isinstance(networks, str):
         networks = [networks]
@@ -22,20 +74,74 @@ def network_catchment_data(networks="all", desc_types="all"):
         networks = config.VALID_NETWORKS
     else:
         for ntwrk in networks:
-            if ntwrk not in config.VALID_NETWORKS:
+            if ntwrk not in config.VALID_NETWORK_SET:
                 raise UserWarning("%s is not a valid network. Choose from %s"
                                   % (ntwrk, ", ".join(config.VALID_NETWORKS)))
 
+    # Check the descriptor types up front, rather than in every worker.
+    desc_types = c_tools.CatchmentData._check_desc_types(desc_types)
+
     transformer = Transformer.from_crs("EPSG:4326", "EPSG:27700")
+    workers = workers or os.cpu_count() or 1
+    tif_threads = max(1, (os.cpu_count() or 1) // workers)
 
     for network_id in networks:
         sites = pd.read_csv(
             paths.SITE_REGISTER_FPATH.format(NETWORK=network_id),
             dtype={"SITE_ID": str})
 
-        for site_row in sites.iterrows():
-            easting, northing = transformer.transform(site_row["LATITUDE"],
-                                                      site_row["LONGITUDE"])
-            catch = c_tools.CatchmentData(easting, northing,
-                                          snap_to_river=True)
-            data = catch.get_data(desc_types=desc_types)
+        savepath = paths.CATCHMENT_DATA_FPATH.format(NETWORK=network_id)
+
+        eastings, northings = transformer.transform(
+            sites["LATITUDE"].to_numpy(), sites["LONGITUDE"].to_numpy())
+        # Order the sites by the RIVER_TILE_SIZE tile they fall in, so each
+        # batch covers a compact area. Its tif sample windows are then small
+        # and dense, and its sites share the river snapping tiles.
+        order = np.lexsort((eastings // c_tools.RIVER_TILE_SIZE,
+                            northings // c_tools.RIVER_TILE_SIZE))
+        stations = sites["SITE_ID"].to_numpy()[order].tolist()
+        coords = list(zip(eastings[order].tolist(),
+                          northings[order].tolist()))
+
+        # Split the sites into a few batches per worker.
+        batch_size = max(1, len(coords) // (workers * 4))
+        batches = [(stations[i:i + batch_size], coords[i:i + batch_size],
+                    desc_types)
+                   for i in range(0, len(coords), batch_size)]
+
+        # Write each batch's data to the network file as it is extracted,
+        # rather than holding every site in memory to combine at the end.
+        # map returns results in batch order. The data is written to a
+        # temporary file (unique, so runs at the same time don't clash),
+        # moved into place once complete, so a failed run never leaves a
+        # partial file behind.
+        fd, temp_fpath = tempfile.mkstemp(
+            suffix=".tmp", dir=os.path.dirname(savepath) or None)
+        try:
+            n_rows = 0
+            with os.fdopen(fd, "w", newline="") as save_file, \
+                    ProcessPoolExecutor(
+                        max_workers=workers,
+                        initializer=c_tools.set_tif_threads,
+                        initargs=(tif_threads,)) as executor:
+                for i, data in enumerate(executor.map(_sites_catchment_data,
+                                                      batches)):
+                    data.to_csv(save_file, index=False, header=(i == 0))
+                    n_rows += len(data)
+
+            if n_rows == 0:
+                print("No catchment data for %s, %s not updated"
+                      % (network_id, savepath))
+                os.remove(temp_fpath)
+                continue
+
+            # mkstemp files are private, so give it the permissions open
+            # would have.
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(temp_fpath, 0o666 & ~umask)
+            os.replace(temp_fpath, savepath)
+        except BaseException:
+            if os.path.exists(temp_fpath):
+                os.remove(temp_fpath)
+            raise